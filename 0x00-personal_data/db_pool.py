@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+""" A module that defines a pool of database connections """
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Iterator
+import os
+import threading
+import time
+
+from filtered_logger import get_db
+
+
+POOL_SIZE = 5
+POOL_IDLE_TIMEOUT = 300.0
+
+
+class ConnectionPool:
+    """ Pool of reusable database connections
+    """
+
+    def __init__(self, connect: Callable = get_db, size: int = POOL_SIZE,
+                 idle_timeout: float = POOL_IDLE_TIMEOUT):
+        """
+        Initialize a connection pool
+        Args:
+            connect (callable): factory opening a new connection
+            size (int): maximum number of connections open at once
+            idle_timeout (float): seconds after which an idle connection
+                is closed instead of being reused
+        """
+        if size < 1:
+            raise ValueError("pool size must be at least 1")
+        self.connect = connect
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = False
+
+    @staticmethod
+    def _is_healthy(conn) -> bool:
+        """
+        Check that a connection can still be used
+        Args:
+            conn: connection to check
+        Return:
+            True if the connection answers, False otherwise
+        """
+        try:
+            if hasattr(conn, 'is_connected'):
+                return conn.is_connected()
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _discard(conn):
+        """
+        Close a connection, ignoring errors from a dead link
+        """
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self, timeout: float = None):
+        """
+        Check out a connection, reusing an idle one when it is still fresh
+        and healthy, opening a new one otherwise
+        Args:
+            timeout (float): seconds to wait for a free slot, None to block
+        Return:
+            a connection, to be given back with `release`
+        """
+        if self._closed:
+            raise RuntimeError("connection pool is closed")
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError("no connection available in the pool")
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    conn, last_used = self._idle.pop()
+                if time.monotonic() - last_used > self.idle_timeout:
+                    self._discard(conn)
+                elif self._is_healthy(conn):
+                    return conn
+                else:
+                    self._discard(conn)
+            return self.connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        """
+        Give a connection back to the pool
+        Args:
+            conn: connection obtained from `acquire`
+        """
+        with self._lock:
+            if self._closed:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+        self._slots.release()
+
+    @contextmanager
+    def connection(self, timeout: float = None) -> Iterator:
+        """
+        Context manager checking out a connection for the `with` block
+        Args:
+            timeout (float): seconds to wait for a free slot, None to block
+        """
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """
+        Close every idle connection and refuse new checkouts
+        """
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, deque()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def __enter__(self):
+        """ Use the pool as a context manager
+        """
+        return self
+
+    def __exit__(self, *exc):
+        """ Close the pool when leaving the `with` block
+        """
+        self.close()
+
+
+def get_db_pool(connect: Callable = get_db) -> ConnectionPool:
+    """
+    Returns a connection pool configured from the environment, using the
+    same PERSONAL_DATA_DB_* variables as get_db
+    """
+    try:
+        size = int(os.getenv('PERSONAL_DATA_DB_POOL_SIZE'))
+    except Exception:
+        size = POOL_SIZE
+    try:
+        idle_timeout = float(os.getenv('PERSONAL_DATA_DB_POOL_IDLE_TIMEOUT'))
+    except Exception:
+        idle_timeout = POOL_IDLE_TIMEOUT
+    return ConnectionPool(connect, size, idle_timeout)
+
+
+class StubCursor:
+    """ Cursor of a StubConnection: answers the `SELECT 1` health check
+    and returns no rows for any other query
+    """
+
+    def __init__(self, connection):
+        """ Open a stub cursor on a stub connection
+        """
+        self.connection = connection
+        self.closed = False
+        self._rows = []
+
+    def execute(self, operation: str, params=None):
+        """ Run a query, failing like a dead link once the cursor or its
+        connection is closed
+        """
+        if self.closed or not self.connection.connected:
+            raise RuntimeError("StubConnection is closed")
+        self.connection.queries.append(operation)
+        if operation.strip().rstrip(';').upper() == "SELECT 1":
+            self._rows = [(1,)]
+        else:
+            self._rows = []
+
+    def fetchall(self) -> list:
+        """ Return the remaining rows of the last query
+        """
+        rows, self._rows = self._rows, []
+        return rows
+
+    def close(self):
+        """ Close the stub cursor
+        """
+        self.closed = True
+
+
+class StubConnection:
+    """ In-memory stand-in for a MySQLConnection, to exercise the pool
+    without a database server
+    """
+
+    opened = 0
+
+    def __init__(self, *args, **kwargs):
+        """ Open a stub connection
+        """
+        StubConnection.opened += 1
+        self.connected = True
+        self.queries = []
+
+    def is_connected(self) -> bool:
+        """ Whether the stub connection is still open
+        """
+        return self.connected
+
+    def cursor(self, *args, **kwargs) -> StubCursor:
+        """ Open a stub cursor
+        """
+        return StubCursor(self)
+
+    def close(self):
+        """ Close the stub connection
+        """
+        self.connected = False
@@ -1,21 +1,106 @@
 #!/usr/bin/env python3
 """ Module to encrypt and validate passwords """
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Tuple
+import os
+import time
 import bcrypt
 from bcrypt import hashpw
 
 
-def hash_password(password: str) -> bytes:
+BCRYPT_DEFAULT_ROUNDS = 12
+BCRYPT_MIN_ROUNDS = 4
+BCRYPT_MAX_ROUNDS = 31
+_rounds = None
+
+
+def get_rounds() -> int:
+    """
+    Returns the bcrypt work factor new hashes are made with: the one set
+    by set_rounds or calibrate_rounds, else PERSONAL_DATA_BCRYPT_ROUNDS
+    if it is within the bcrypt range, else the bcrypt default.
+
+    Returns:
+        int: The current work factor.
+    """
+    if _rounds is not None:
+        return _rounds
+    try:
+        rounds = int(os.getenv('PERSONAL_DATA_BCRYPT_ROUNDS'))
+    except Exception:
+        return BCRYPT_DEFAULT_ROUNDS
+    if not BCRYPT_MIN_ROUNDS <= rounds <= BCRYPT_MAX_ROUNDS:
+        return BCRYPT_DEFAULT_ROUNDS
+    return rounds
+
+
+def set_rounds(rounds: int) -> None:
+    """
+    Sets the bcrypt work factor new hashes are made with.
+
+    Args:
+        rounds (int): The work factor, None to go back to the default.
+    """
+    global _rounds
+    if rounds is not None and \
+            not BCRYPT_MIN_ROUNDS <= rounds <= BCRYPT_MAX_ROUNDS:
+        raise ValueError("bcrypt rounds must be between {} and {}".format(
+            BCRYPT_MIN_ROUNDS, BCRYPT_MAX_ROUNDS))
+    _rounds = rounds
+
+
+def calibrate_rounds(target_ms: float = 250.0,
+                     min_rounds: int = BCRYPT_MIN_ROUNDS,
+                     max_rounds: int = 16, apply: bool = True) -> int:
+    """
+    Finds the highest bcrypt work factor whose verification time stays
+    within a latency budget on this machine. Each extra round doubles
+    the cost, so rounds are raised while twice the last measured time
+    still fits the budget.
+
+    Args:
+        target_ms (float): The verification latency budget in ms.
+        min_rounds (int): The lowest work factor to return.
+        max_rounds (int): The highest work factor to try.
+        apply (bool): Whether to make it the current work factor.
+
+    Returns:
+        int: The calibrated work factor.
+    """
+    password = b"calibration password"
+
+    def verify_ms(rounds: int) -> float:
+        hashed = hashpw(password, bcrypt.gensalt(rounds))
+        start = time.perf_counter()
+        bcrypt.checkpw(password, hashed)
+        return (time.perf_counter() - start) * 1000
+
+    rounds = min_rounds
+    elapsed = verify_ms(rounds)
+    while rounds < max_rounds and elapsed * 2 <= target_ms:
+        rounds += 1
+        elapsed = verify_ms(rounds)
+        if elapsed > target_ms:
+            rounds -= 1
+            break
+    if apply:
+        set_rounds(rounds)
+    return rounds
+
+
+def hash_password(password: str, rounds: int = None) -> bytes:
     """
     Hashes the given password using bcrypt.
 
     Args:
         password (str): The password to be hashed.
+        rounds (int): The work factor, defaults to get_rounds().
 
     Returns:
         bytes: The hashed password.
     """
     b = password.encode()
-    hashed = hashpw(b, bcrypt.gensalt())
+    hashed = hashpw(b, bcrypt.gensalt(rounds or get_rounds()))
     return hashed
 
 
@@ -32,3 +117,88 @@ def is_valid(hashed_password: bytes, password: str) -> bool:
         bool: True if the password is valid, False otherwise.
     """
     return bcrypt.checkpw(password.encode(), hashed_password)
+
+
+def needs_rehash(hashed_password: bytes) -> bool:
+    """
+    Tells whether a hashed password was made with another work factor
+    than the current one.
+
+    Args:
+        hashed_password (bytes): The hashed password to check.
+
+    Returns:
+        bool: True if it should be hashed again, False otherwise.
+    """
+    try:
+        rounds = int(hashed_password.split(b"$")[2])
+    except (IndexError, ValueError):
+        return True
+    return rounds != get_rounds()
+
+
+def check_password(hashed_password: bytes,
+                   password: str) -> Tuple[bool, bool]:
+    """
+    Validates a password like is_valid, also telling whether the hashed
+    password should be replaced by hash_password(password).
+
+    Args:
+        hashed_password (bytes): The hashed password
+        to be validated against.
+        password (str): The password to be validated.
+
+    Returns:
+        tuple: (valid, needs rehash). A password needs a rehash when it
+        is valid and its hash was made with another work factor.
+    """
+    valid = is_valid(hashed_password, password)
+    return valid, valid and needs_rehash(hashed_password)
+
+
+def hash_passwords(passwords: Iterable[str],
+                   workers: int = None) -> List[bytes]:
+    """
+    Hashes many passwords at once using bcrypt on a thread pool.
+    bcrypt releases the GIL while hashing, so the passwords are hashed
+    in parallel.
+
+    Args:
+        passwords (iterable of str): The passwords to be hashed.
+        workers (int): The number of threads, defaults to the
+        ThreadPoolExecutor default.
+
+    Returns:
+        list of bytes: The hashed passwords, in the order of `passwords`.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(hash_password, passwords))
+
+
+def verify_many(hashed_passwords: Iterable[bytes], passwords: Iterable[str],
+                workers: int = None) -> List[bool]:
+    """
+    Validates many passwords against their hashed passwords using bcrypt
+    on a thread pool.
+
+    Args:
+        hashed_passwords (iterable of bytes): The hashed passwords
+        to be validated against.
+        passwords (iterable of str): The passwords to be validated, in
+        the order of `hashed_passwords`.
+        workers (int): The number of threads, defaults to the
+        ThreadPoolExecutor default.
+
+    Returns:
+        list of bool: Whether each password is valid, in order.
+
+    Raises:
+        ValueError: If there are not as many passwords as hashed
+        passwords.
+    """
+    hashed_passwords, passwords = list(hashed_passwords), list(passwords)
+    if len(hashed_passwords) != len(passwords):
+        raise ValueError("got {} hashed passwords for {} passwords".format(
+            len(hashed_passwords), len(passwords)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(is_valid, hashed_passwords, passwords))
@@ -1,13 +1,47 @@
 #!/usr/bin/env python3
 """ A module that defines a filter_datum function """
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from logging.handlers import QueueHandler, QueueListener
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+import atexit
+import copy
+import hashlib
+import hmac
+import json
+import queue
 import re
 import logging
 import os
+import shutil
+import sys
+import threading
+import time
 import mysql.connector
 
 
 PII_FIELDS = ('name', 'email', 'phone', 'ssn', 'password')
+REDACTOR_CACHE_SIZE = 128
+EXPORT_BATCH_SIZE = 1000
+
+
+@lru_cache(maxsize=REDACTOR_CACHE_SIZE)
+def _redactor(fields: Tuple[str, ...], redaction: str,
+              separator: str) -> Callable[[str], str]:
+    """
+    Compile a single-pass redactor for a (fields, redaction, separator)
+    combination. All fields share one alternation pattern, so a message is
+    scanned once whatever the number of fields. Compiled redactors are kept
+    in a bounded LRU cache.
+    Args:
+        fields (tuple): fields to obfuscate
+        redaction (str): what the fields will be obfuscated to
+        separator (str): the character separating the fields
+    Return:
+        callable taking a message and returning it obfuscated
+    """
+    pattern = re.compile('(' + '|'.join(fields) + ')=.*?' + separator)
+    return partial(pattern.sub, r'\g<1>=' + redaction + separator)
 
 
 def filter_datum(fields: List[str], redaction: str,
@@ -20,10 +54,9 @@ def filter_datum(fields: List[str], redaction: str,
         message (str): the log line to obfuscate
         separator (str): the character separating the fields
     """
-    for field in fields:
-        message = re.sub(field+'=.*?'+separator,
-                         field+'='+redaction+separator, message)
-    return message
+    if not fields:
+        return message
+    return _redactor(tuple(fields), redaction, separator)(message)
 
 
 class RedactingFormatter(logging.Formatter):
@@ -40,23 +73,169 @@ class RedactingFormatter(logging.Formatter):
 
     def format(self, record: logging.LogRecord) -> str:
         """
-        redact the message of LogRecord instance
+        redact the message of LogRecord instance. Records logged with
+        `extra={'redacted': True}` are already redacted and left as is
         Args:
         record (logging.LogRecord): LogRecord instance containing message
         Return:
             formatted string
         """
         message = super(RedactingFormatter, self).format(record)
+        if getattr(record, 'redacted', False):
+            return message
         redacted = filter_datum(self.fields, self.REDACTION,
                                 message, self.SEPARATOR)
         return redacted
 
 
-def get_logger() -> logging.Logger:
+class FastRedactingFormatter(RedactingFormatter):
+    """ Redacting Formatter that skips redaction of lines without PII
+        """
+
+    def __init__(self, fields: List[str]):
+        super(FastRedactingFormatter, self).__init__(fields)
+        # the `field=` prefilter only holds for literal field names
+        if all(re.escape(field) == field for field in fields):
+            self.keys = tuple(field + '=' for field in fields)
+        else:
+            self.keys = None
+        self._time_cache = (None, None)
+
+    def formatTime(self, record: logging.LogRecord,
+                   datefmt: str = None) -> str:
+        """
+        Format the creation time of a LogRecord instance, reusing the
+        formatted date and time of the previous record from the same second
+        Args:
+        record (logging.LogRecord): LogRecord instance to timestamp
+        datefmt (str): strftime format of the timestamp
+        Return:
+            formatted timestamp
+        """
+        second = int(record.created)
+        cached_second, formatted = self._time_cache
+        if cached_second != second:
+            formatted = time.strftime(datefmt or self.default_time_format,
+                                      self.converter(record.created))
+            self._time_cache = (second, formatted)
+        if datefmt or not self.default_msec_format:
+            return formatted
+        return self.default_msec_format % (formatted, record.msecs)
+
+    def format(self, record: logging.LogRecord) -> str:
+        """
+        redact the message of LogRecord instance, only running the field
+        patterns when one of the `field=` keys occurs in the line
+        Args:
+        record (logging.LogRecord): LogRecord instance containing message
+        Return:
+            formatted string
+        """
+        message = logging.Formatter.format(self, record)
+        if getattr(record, 'redacted', False):
+            return message
+        if self.keys is not None and \
+                not any(key in message for key in self.keys):
+            return message
+        return filter_datum(self.fields, self.REDACTION,
+                            message, self.SEPARATOR)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """ Queue handler that hands records to a bounded queue, applying an
+        overflow policy when the queue is full
+        """
+
+    OVERFLOW_POLICIES = ('block', 'drop-oldest', 'drop-newest')
+
+    def __init__(self, log_queue: queue.Queue, overflow: str = 'block'):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("unknown overflow policy: {}".format(overflow))
+        super(BoundedQueueHandler, self).__init__(log_queue)
+        self.overflow = overflow
+        self.enqueued = 0
+        self.dropped = 0
+        self._counter_lock = threading.Lock()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Merge the message arguments of a LogRecord instance, leaving the
+        formatting and redaction to the listener thread
+        Args:
+        record (logging.LogRecord): LogRecord instance to enqueue
+        Return:
+            copy of the record with its message merged
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        """
+        Put a record on the queue according to the overflow policy
+        Args:
+        record (logging.LogRecord): LogRecord instance to enqueue
+        """
+        if self.overflow == 'block':
+            self.queue.put(record)
+        elif self.overflow == 'drop-newest':
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                with self._counter_lock:
+                    self.dropped += 1
+                return
+        else:
+            while True:
+                try:
+                    self.queue.put_nowait(record)
+                    break
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                    except queue.Empty:
+                        continue
+                    with self._counter_lock:
+                        self.dropped += 1
+        with self._counter_lock:
+            self.enqueued += 1
+
+
+class BoundedQueueListener(QueueListener):
+    """ Queue listener that can be stopped while its queue is full, and
+        stopped more than once
+        """
+
+    def stop(self):
+        """
+        Flush the queue and stop the listener thread if it is running
+        """
+        if self._thread is not None:
+            super(BoundedQueueListener, self).stop()
+
+    def enqueue_sentinel(self):
+        """
+        Wait for room on the queue to post the stop sentinel
+        """
+        self.queue.put(self._sentinel)
+
+
+def get_logger(queue_size: int = 0,
+               overflow: str = 'block') -> logging.Logger:
     """
     Return a logging.Logger object
+    The logger is configured once: later calls return it unchanged.
+    Args:
+        queue_size (int): when positive, records go through a queue of
+            this size and are redacted and written by a listener thread,
+            so logging never formats on the caller's thread
+        overflow (str): what to do when the queue is full, one of
+            'block', 'drop-oldest' or 'drop-newest'
     """
     logger = logging.getLogger("user_data")
+    if logger.handlers:
+        return logger
     logger.setLevel(logging.INFO)
     logger.propagate = False
 
@@ -65,6 +244,13 @@ def get_logger() -> logging.Logger:
     formatter = RedactingFormatter(PII_FIELDS)
 
     handler.setFormatter(formatter)
+    if queue_size > 0:
+        queue_handler = BoundedQueueHandler(queue.Queue(queue_size), overflow)
+        listener = BoundedQueueListener(queue_handler.queue, handler)
+        queue_handler.listener = listener
+        listener.start()
+        atexit.register(listener.stop)
+        handler = queue_handler
     logger.addHandler(handler)
     return logger
 
@@ -84,20 +270,334 @@ def get_db() -> mysql.connector.connection.MySQLConnection:
     return conn
 
 
+def format_row(fields: Sequence[str], row: Iterable) -> str:
+    """
+    Build the log line of a database row
+    Args:
+        fields (sequence): column names of the row
+        row (iterable): column values of the row
+    Return:
+        the row as a `field=value;` string
+    """
+    message = "".join("{}={}; ".format(k, v) for k, v in zip(fields, row))
+    return message.strip()
+
+
+class RowRedactor:
+    """ Redacts database rows column by column, before they are turned
+        into a log line
+        """
+
+    POLICIES = ('keep', 'redact', 'hash', 'truncate')
+
+    def __init__(self, columns: Sequence[str], policies: Dict[str, str] = None,
+                 redaction: str = RedactingFormatter.REDACTION,
+                 hash_key: bytes = None, truncate_length: int = 4):
+        """
+        Initialize a row redactor
+        Args:
+            columns (sequence): column names of the rows
+            policies (dict): policy of each column, one of 'keep',
+                'redact', 'hash' or 'truncate'. Defaults to redacting
+                PII_FIELDS; columns without a policy are kept
+            redaction (str): what 'redact' columns are obfuscated to
+            hash_key (bytes): key of the HMAC-SHA256 of 'hash' columns,
+                defaults to the PERSONAL_DATA_HASH_KEY variable
+            truncate_length (int): characters kept by 'truncate' columns
+        """
+        if policies is None:
+            policies = {field: 'redact' for field in PII_FIELDS}
+        for column, policy in policies.items():
+            if policy not in self.POLICIES:
+                raise ValueError("unknown policy for {}: {}".format(column,
+                                                                    policy))
+        if hash_key is None and os.getenv('PERSONAL_DATA_HASH_KEY'):
+            hash_key = os.getenv('PERSONAL_DATA_HASH_KEY').encode()
+        if hash_key is None and 'hash' in policies.values():
+            raise ValueError("a hash key is required by the 'hash' policy")
+        self.columns = tuple(columns)
+        self.redaction = redaction
+        self.hash_key = hash_key
+        self.truncate_length = truncate_length
+        self._policies = [policies.get(column, 'keep')
+                          for column in self.columns]
+
+    def _apply(self, policy: str, value):
+        """
+        Apply a column policy to a value
+        """
+        if policy == 'keep' or value is None:
+            return value
+        if policy == 'redact':
+            return self.redaction
+        if policy == 'hash':
+            return hmac.new(self.hash_key, str(value).encode(),
+                            hashlib.sha256).hexdigest()
+        return str(value)[:self.truncate_length]
+
+    def redact(self, row) -> list:
+        """
+        Redact a row
+        Args:
+            row: column values in column order, or a dict keyed by column
+        Return:
+            list of the redacted values in column order
+        """
+        if isinstance(row, dict):
+            row = [row.get(column) for column in self.columns]
+        return [self._apply(policy, value)
+                for policy, value in zip(self._policies, row)]
+
+    def to_line(self, row) -> str:
+        """
+        Redact a row into the `field=value;` log line format
+        """
+        return format_row(self.columns, self.redact(row))
+
+    def to_json(self, row) -> str:
+        """
+        Redact a row into a JSON object
+        """
+        return json.dumps(dict(zip(self.columns, self.redact(row))),
+                          default=str)
+
+
+def export_users(db, logger: logging.Logger,
+                 batch_size: int = EXPORT_BATCH_SIZE,
+                 policies: Dict[str, str] = None,
+                 output: str = None) -> Dict[str, float]:
+    """
+    Stream the users table to a logger in fixed size batches.
+    Rows are read with `fetchmany` on an unbuffered cursor (the default for
+    MySQLConnection), so at most `batch_size` rows are held in memory
+    whatever the size of the table. Any DB-API connection can be used,
+    e.g. a sqlite3 connection in place of MySQL.
+    Args:
+        db: DB-API connection to read the users table from
+        logger (logging.Logger): logger the rows are written to
+        batch_size (int): number of rows fetched per round trip
+        policies (dict): column policies of a RowRedactor
+        output (str): None to log rows and let the formatter redact them,
+            or 'line' or 'json' to redact rows by column with a
+            RowRedactor and log them in that format, bypassing the
+            formatter's field patterns
+    Return:
+        export report with the number of rows and batches, the elapsed
+        time in seconds and the throughput in rows per second
+    """
+    start = time.perf_counter()
+    rows = batches = 0
+    cursor = db.cursor()
+    try:
+        cursor.execute("SELECT * FROM users;")
+        fields = [column[0] for column in cursor.description]
+        if output is None:
+            to_message, extra = partial(format_row, fields), None
+        elif output in ('line', 'json'):
+            redactor = RowRedactor(fields, policies)
+            to_message = getattr(redactor, 'to_' + output)
+            extra = {'redacted': True}
+        else:
+            raise ValueError("unknown output format: {}".format(output))
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if not batch:
+                break
+            batches += 1
+            rows += len(batch)
+            for row in batch:
+                logger.info(to_message(row), extra=extra)
+    finally:
+        cursor.close()
+    elapsed = time.perf_counter() - start
+    return {
+        "rows": rows,
+        "batches": batches,
+        "elapsed": elapsed,
+        "rows_per_second": rows / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def _check_key(db, key: str):
+    """
+    Check that the users table has the column the export is sharded on
+    Args:
+        db: DB-API connection to read the users table from
+        key (str): integer primary key column of the users table
+    Raise:
+        ValueError if the users table has no such column
+    """
+    cursor = db.cursor()
+    try:
+        cursor.execute("SELECT * FROM users LIMIT 0;")
+        columns = [column[0] for column in cursor.description]
+        cursor.fetchall()
+    finally:
+        cursor.close()
+    if key not in columns:
+        raise ValueError("the users table has no key column {!r}, set "
+                         "PERSONAL_DATA_EXPORT_KEY to one of: {}"
+                         .format(key, ", ".join(columns)))
+
+
+def _key_ranges(db, key: str, shards: int) -> List[Tuple[int, int]]:
+    """
+    Split the users table into contiguous primary key ranges
+    Args:
+        db: DB-API connection to read the users table from
+        key (str): integer primary key column of the users table
+        shards (int): number of ranges to produce
+    Return:
+        list of half-open (low, high) ranges covering every key
+    """
+    cursor = db.cursor()
+    try:
+        cursor.execute("SELECT MIN({0}), MAX({0}) FROM users;".format(key))
+        low, high = cursor.fetchone()
+    finally:
+        cursor.close()
+    if low is None:
+        return []
+    try:
+        low, high = int(low), int(high) + 1
+    except ValueError:
+        raise ValueError("key column {!r} does not hold integers"
+                         .format(key))
+    step = max(1, -(-(high - low) // shards))
+    return [(start, min(start + step, high))
+            for start in range(low, high, step)]
+
+
+def _export_shard(shard: Tuple) -> int:
+    """
+    Export one primary key range of the users table to a file.
+    Runs in a worker process with its own database connection.
+    Args:
+        shard (tuple): (low, high, key, path, batch_size, connect)
+    Return:
+        number of rows exported
+    """
+    low, high, key, path, batch_size, connect = shard
+    formatter = RedactingFormatter(PII_FIELDS)
+    rows = 0
+    db = connect()
+    try:
+        cursor = db.cursor()
+        cursor.execute("SELECT * FROM users WHERE {0} >= {1:d} AND {0} < {2:d}"
+                       " ORDER BY {0};".format(key, low, high))
+        fields = [column[0] for column in cursor.description]
+        with open(path, 'w') as f:
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                rows += len(batch)
+                for row in batch:
+                    record = logging.LogRecord("user_data", logging.INFO,
+                                               __file__, 0,
+                                               format_row(fields, row),
+                                               None, None)
+                    f.write(formatter.format(record) + "\n")
+        cursor.close()
+    finally:
+        db.close()
+    return rows
+
+
+def export_users_parallel(out_dir: str, workers: int = None,
+                          shards: int = None, key: str = "id",
+                          merge_to: str = None,
+                          batch_size: int = EXPORT_BATCH_SIZE,
+                          connect: Callable = get_db) -> Dict[str, float]:
+    """
+    Export the users table across a pool of worker processes.
+    The table is split into ranges of its integer primary key and each
+    range is exported, ordered by key, by a worker with its own connection
+    into `<out_dir>/users-<shard>.log`. Shard files are numbered in key
+    order, so concatenating them gives a deterministic ordered export.
+    Args:
+        out_dir (str): directory the shard files are written to
+        workers (int): number of worker processes, defaults to CPU count
+        shards (int): number of key ranges, defaults to `workers`
+        key (str): integer primary key column of the users table
+        merge_to (str): optional file the shards are merged into, in order
+        batch_size (int): number of rows fetched per round trip
+        connect (callable): picklable connection factory used by workers
+    Return:
+        export report with the number of rows and shards, the shard files,
+        the elapsed time in seconds and the throughput in rows per second
+    Raise:
+        ValueError if `key` is not an integer column of the users table,
+        before any worker is started
+    """
+    if not re.fullmatch(r'\w+', key):
+        raise ValueError("invalid key column: {}".format(key))
+    workers = workers or os.cpu_count() or 1
+    shards = shards or workers
+    start = time.perf_counter()
+    db = connect()
+    try:
+        _check_key(db, key)
+        ranges = _key_ranges(db, key, shards)
+    finally:
+        db.close()
+    os.makedirs(out_dir, exist_ok=True)
+    paths = [os.path.join(out_dir, "users-{:04d}.log".format(i))
+             for i in range(len(ranges))]
+    jobs = [(low, high, key, p, batch_size, connect)
+            for (low, high), p in zip(ranges, paths)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        rows = sum(executor.map(_export_shard, jobs))
+    if merge_to is not None:
+        with open(merge_to, 'w') as out:
+            for p in paths:
+                with open(p, 'r') as f:
+                    shutil.copyfileobj(f, out)
+    elapsed = time.perf_counter() - start
+    return {
+        "rows": rows,
+        "shards": len(paths),
+        "files": paths,
+        "elapsed": elapsed,
+        "rows_per_second": rows / elapsed if elapsed > 0 else 0.0,
+    }
+
+
 def main():
     """
     main entry point
     """
+    try:
+        batch_size = int(os.getenv('PERSONAL_DATA_BATCH_SIZE'))
+    except Exception:
+        batch_size = EXPORT_BATCH_SIZE
+    try:
+        workers = int(os.getenv('PERSONAL_DATA_EXPORT_WORKERS'))
+    except Exception:
+        workers = 1
+    if workers > 1:
+        out_dir = os.getenv('PERSONAL_DATA_EXPORT_DIR') or "export"
+        key = os.getenv('PERSONAL_DATA_EXPORT_KEY') or "id"
+        try:
+            report = export_users_parallel(out_dir, workers, key=key,
+                                           merge_to=os.path.join(
+                                               out_dir, "users.log"),
+                                           batch_size=batch_size)
+        except ValueError as e:
+            sys.exit("export failed: {}".format(e))
+        print("exported {rows} rows in {shards} shards in {elapsed:.2f}s "
+              "({rows_per_second:.0f} rows/s)".format(**report),
+              file=sys.stderr)
+        return
     db = get_db()
     logger = get_logger()
-    cursor = db.cursor()
-    cursor.execute("SELECT * FROM users;")
-    fields = cursor.column_names
-    for row in cursor:
-        message = "".join("{}={}; ".format(k, v) for k, v in zip(fields, row))
-        logger.info(message.strip())
-    cursor.close()
-    db.close()
+    try:
+        report = export_users(db, logger, batch_size,
+                              output=os.getenv('PERSONAL_DATA_EXPORT_FORMAT'))
+    finally:
+        db.close()
+    print("exported {rows} rows in {batches} batches in {elapsed:.2f}s "
+          "({rows_per_second:.0f} rows/s)".format(**report), file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+""" A module that redacts existing log files with filter_datum """
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple
+import argparse
+import mmap
+import os
+import sys
+import time
+
+from filtered_logger import PII_FIELDS, RedactingFormatter, filter_datum
+
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def chunk_bounds(data: mmap.mmap, chunk_size: int) -> List[Tuple[int, int]]:
+    """
+    Split a mapped file into chunks ending on a line boundary
+    Args:
+        data (mmap.mmap): memory map of the whole file
+        chunk_size (int): approximate size in bytes of each chunk
+    Return:
+        list of half-open (start, end) byte offsets covering the file
+    """
+    bounds = []
+    start, size = 0, len(data)
+    while start < size:
+        end = data.find(b'\n', min(start + chunk_size, size) - 1)
+        end = size if end == -1 else end + 1
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+def _redact_chunk(job: Tuple) -> bytes:
+    """
+    Redact one chunk of a log file. Runs in a worker process that maps
+    the file itself, so only the redacted output crosses processes.
+    Args:
+        job (tuple): (path, start, end, fields, redaction, separator)
+    Return:
+        the redacted chunk
+    """
+    path, start, end, fields, redaction, separator = job
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            text = data[start:end].decode('utf-8', 'surrogateescape')
+    # `.` never matches a newline, so redacting the chunk at once gives
+    # the same output as redacting it line by line
+    return filter_datum(fields, redaction, text,
+                        separator).encode('utf-8', 'surrogateescape')
+
+
+def redact_file(src: str, dst: str, fields: List[str] = PII_FIELDS,
+                redaction: str = RedactingFormatter.REDACTION,
+                separator: str = RedactingFormatter.SEPARATOR,
+                workers: int = None,
+                chunk_size: int = CHUNK_SIZE) -> dict:
+    """
+    Redact a log file into another one across worker processes.
+    At most two chunks per worker are in flight at once, so memory stays
+    bounded whatever the size of the file, and chunks are written in
+    their original order.
+    Args:
+        src (str): log file to redact
+        dst (str): file the redacted log is written to
+        fields (list): fields to obfuscate
+        redaction (str): what the fields will be obfuscated to
+        separator (str): the character separating the fields
+        workers (int): number of worker processes, defaults to CPU count
+        chunk_size (int): approximate size in bytes of each chunk
+    Return:
+        report with the number of bytes and chunks read, the elapsed time
+        in seconds and the throughput in MB/s
+    """
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    size = os.path.getsize(src)
+    bounds = []
+    if size:
+        with open(src, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                bounds = chunk_bounds(data, chunk_size)
+    jobs = ((src, s, e, tuple(fields), redaction, separator)
+            for s, e in bounds)
+    with open(dst, 'wb') as out, \
+            ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for job in jobs:
+            pending.append(executor.submit(_redact_chunk, job))
+            if len(pending) >= 2 * workers:
+                out.write(pending.popleft().result())
+        while pending:
+            out.write(pending.popleft().result())
+    elapsed = time.perf_counter() - start
+    return {
+        "bytes": size,
+        "chunks": len(bounds),
+        "elapsed": elapsed,
+        "mb_per_second": size / 1e6 / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def main(argv: List[str] = None):
+    """
+    main entry point
+    """
+    parser = argparse.ArgumentParser(
+        description="Redact PII fields from an existing log file")
+    parser.add_argument('src', help="log file to redact")
+    parser.add_argument('dst', help="file the redacted log is written to")
+    parser.add_argument('-f', '--fields', nargs='+', default=PII_FIELDS,
+                        help="fields to obfuscate")
+    parser.add_argument('-r', '--redaction',
+                        default=RedactingFormatter.REDACTION,
+                        help="what the fields will be obfuscated to")
+    parser.add_argument('-s', '--separator',
+                        default=RedactingFormatter.SEPARATOR,
+                        help="the character separating the fields")
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help="number of worker processes")
+    parser.add_argument('-c', '--chunk-size', type=int, default=CHUNK_SIZE,
+                        help="approximate size in bytes of each chunk")
+    args = parser.parse_args(argv)
+    report = redact_file(args.src, args.dst, args.fields, args.redaction,
+                         args.separator, args.workers, args.chunk_size)
+    print("redacted {bytes} bytes in {chunks} chunks in {elapsed:.2f}s "
+          "({mb_per_second:.1f} MB/s)".format(**report), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,14 @@
 """
 from flask import jsonify, abort
 from api.v1.views import app_views
+import re
+
+
+def stats_name(model: type) -> str:
+    """ Name of a model in the stats: its class name in snake case and
+    plural, such as user_sessions for UserSession
+    """
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', model.__name__).lower() + 's'
 
 
 @app_views.route('/unauthorized', methods=['GET'], strict_slashes=False)
@@ -36,9 +44,24 @@ def status() -> str:
 def stats() -> str:
     """ GET /api/v1/stats
     Return:
-      - the number of each objects
+      - the number of each objects, by model
+      - `active` and `expired`: the number of objects of the models that
+        expire, such as sessions
+      - `bytes`: the size in bytes of the stored objects of each model
+    All counters are kept up to date by the models, none is computed by
+    scanning the objects, except with the "sqlite" storage where the
+    models are counted with a COUNT query
     """
+    from models.base import Base
+    # imported so that Base.models() finds every model
     from models.user import User
-    stats = {}
-    stats['users'] = User.count()
+    stats = {'bytes': {}}
+    for model in Base.models():
+        name = stats_name(model)
+        model_stats = model.stats()
+        stats[name] = model_stats['count']
+        stats['bytes'][name] = model_stats['bytes']
+        for key in ('active', 'expired'):
+            if key in model_stats:
+                stats.setdefault(key, {})[name] = model_stats[key]
     return jsonify(stats)
@@ -6,14 +6,37 @@ from flask import abort, jsonify, request
 from models.user import User
 
 
+MAX_PAGE_SIZE = 1000
+MAX_BATCH_SIZE = 10000
+
+
 @app_views.route('/users', methods=['GET'], strict_slashes=False)
 def view_all_users() -> str:
     """ GET /api/v1/users
+    Query parameters (optional):
+      - limit: number of users per page, up to MAX_PAGE_SIZE
+      - cursor: next_cursor of the previous page
     Return:
       - list of all User objects JSON represented
+      - with limit or cursor: the page of User objects JSON represented
+        in `users` and the cursor of the next page in `next_cursor`
+        (null on the last page)
+      - 400 if limit is not a positive integer
     """
-    all_users = [user.to_json() for user in User.all()]
-    return jsonify(all_users)
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    if limit is None and cursor is None:
+        all_users = [user.to_json() for user in User.all()]
+        return jsonify(all_users)
+    try:
+        limit = MAX_PAGE_SIZE if limit is None else int(limit)
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        return jsonify({'error': "limit must be a positive integer"}), 400
+    users, next_cursor = User.page(min(limit, MAX_PAGE_SIZE), cursor or None)
+    return jsonify({'users': [user.to_json() for user in users],
+                    'next_cursor': next_cursor})
 
 
 @app_views.route('/users/<user_id>', methods=['GET'], strict_slashes=False)
@@ -89,6 +112,61 @@ def create_user() -> str:
     return jsonify({'error': error_msg}), 400
 
 
+@app_views.route('/users/batch', methods=['POST'], strict_slashes=False)
+def batch_users() -> str:
+    """ POST /api/v1/users/batch
+    JSON body:
+      - create (optional): list of users, each with the JSON body of
+        POST /api/v1/users
+      - delete (optional): list of User IDs
+    All users are validated before any change, and each list is
+    persisted at once
+    Return:
+      - created User objects JSON represented in `created` and the
+        number of deleted Users in `deleted`
+      - 400 if a user can't be created or the batch is too large
+    """
+    rj = None
+    try:
+        rj = request.get_json()
+    except Exception as e:
+        rj = None
+    if not isinstance(rj, dict):
+        return jsonify({'error': "Wrong format"}), 400
+    to_create = rj.get("create") or []
+    to_delete = rj.get("delete") or []
+    if not isinstance(to_create, list) or not isinstance(to_delete, list):
+        return jsonify({'error': "Wrong format"}), 400
+    if len(to_create) + len(to_delete) > MAX_BATCH_SIZE:
+        return jsonify({'error': "batch larger than {}".format(
+            MAX_BATCH_SIZE)}), 400
+    users = []
+    for i, uj in enumerate(to_create):
+        error_msg = None
+        if not isinstance(uj, dict):
+            error_msg = "Wrong format"
+        elif uj.get("email", "") == "":
+            error_msg = "email missing"
+        elif uj.get("password", "") == "":
+            error_msg = "password missing"
+        if error_msg is not None:
+            return jsonify({'error': "create[{}]: {}".format(
+                i, error_msg)}), 400
+        user = User()
+        user.email = uj.get("email")
+        user.password = uj.get("password")
+        user.first_name = uj.get("first_name")
+        user.last_name = uj.get("last_name")
+        users.append(user)
+    try:
+        User.save_many(users)
+        deleted = User.remove_many(str(user_id) for user_id in to_delete)
+    except Exception as e:
+        return jsonify({'error': "Can't apply batch: {}".format(e)}), 400
+    return jsonify({'created': [user.to_json() for user in users],
+                    'deleted': deleted}), 201
+
+
 @app_views.route('/users/<user_id>', methods=['PUT'], strict_slashes=False)
 def update_user(user_id: str = None) -> str:
     """ PUT /api/v1/users/:id
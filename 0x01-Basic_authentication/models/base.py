@@ -1,39 +1,407 @@
 #!/usr/bin/env python3
 """ Base module
 """
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
 from datetime import datetime
-from typing import TypeVar, List, Iterable
-from os import path
-import json
+from functools import cmp_to_key
+from itertools import islice
+from typing import (TypeVar, Callable, List, Iterable, Iterator, Optional,
+                    Tuple)
+from operator import attrgetter
+import operator
+from os import getenv
+import atexit
+import heapq
+import logging
+import signal
+import threading
+import time
 import uuid
 
+from models.storage import Storage, get_storage
+
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+EPOCH = datetime(1970, 1, 1)
 DATA = {}
+INDEX = {}
+INDEX_KEYS = {}
+LAZY = {}
+FIELDS = {}
+SERIALIZERS = {}
+STATES = {}
+ORDER = {}
+LOCKS = {}
+QUERIES = {}
+EXPIRY = {}
+_locks_lock = threading.Lock()
+# slots holding runtime state, never serialized
+TRANSIENT_FIELDS = ('_json_cache',)
+# key of the serialization of an object from before its attributes
+# changed, kept in its _json_cache to tell what the next save() changes
+SAVED_JSON = "saved"
+
+# name of the storage backend, see models.storage: "file" rewrites
+# .db_<Class>.json on every change, "journal" appends the change to
+# .db_<Class>.journal and compacts it into the snapshot later, "sqlite"
+# writes rows of one table per class and reads objects on demand
+STORAGE = getenv("MODELS_STORAGE", "file")
+# number of objects iterate() reads at once from a queryable storage, or
+# of IDs it copies at once from the sorted IDs of the others
+STORAGE_PAGE_SIZE = int(getenv("MODELS_STORAGE_PAGE_SIZE", 1000))
+# number of objects of a queryable storage kept in memory: the objects
+# least recently read or saved are dropped first
+CACHE_SIZE = int(getenv("MODELS_CACHE_SIZE", 10000))
+
+# lazy loading: load_from_file keeps the parsed JSON of each object and
+# only builds it on first access through get(), or when a query needs
+# every object
+LAZY_LOAD = getenv("MODELS_LAZY_LOAD", "") in ("1", "true", "yes")
+
+# write-behind: changes only mark the class dirty and a background thread
+# saves dirty classes every FLUSH_INTERVAL seconds, or as soon as
+# FLUSH_THRESHOLD changes are pending, and at process exit. Ignored by
+# classes with a queryable storage, which write each change to its row
+WRITE_BEHIND = getenv("MODELS_WRITE_BEHIND", "") in ("1", "true", "yes")
+FLUSH_INTERVAL = float(getenv("MODELS_FLUSH_INTERVAL", 1))
+FLUSH_THRESHOLD = int(getenv("MODELS_FLUSH_THRESHOLD", 1000))
+# seconds SIGTERM waits for the flusher thread before exiting, the rest
+# being saved at exit
+FLUSH_SIGNAL_TIMEOUT = float(getenv("MODELS_FLUSH_SIGNAL_TIMEOUT", 5))
+DIRTY = {}
+FLUSH_STATS = {"flushes": 0, "writes": 0, "coalesced": 0}
+_flush_lock = threading.Lock()
+# held for a whole flush, so that the one at exit waits for the flusher
+_flushing = threading.Lock()
+_flush_wakeup = threading.Event()
+# events set by the flusher thread once it has flushed
+_flush_requests = []
+_flusher = None
+
+# coherence between processes sharing the storage, such as pre-forked
+# workers: reads first catch up with the changes other processes wrote,
+# checking the storage at most every COHERENCE_INTERVAL seconds, and
+# changes are made under an inter-process lock once caught up. Ignored by
+# classes in write-behind mode
+COHERENT = getenv("MODELS_COHERENT", "") in ("1", "true", "yes")
+COHERENCE_INTERVAL = float(getenv("MODELS_COHERENCE_INTERVAL", 0))
+SYNC = {}
+WRITING = set()
+COHERENCE_STATS = {"checks": 0, "reloads": 0, "replayed": 0,
+                   "check_seconds": 0.0, "lock_seconds": 0.0}
+
+
+def _parse_timestamp(value: str) -> datetime:
+    """ Parse a TIMESTAMP_FORMAT date, with the C ISO parser when the value
+    has the fixed YYYY-MM-DDTHH:MM:SS layout
+    """
+    if len(value) == 19 and value[10] == 'T':
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    return datetime.strptime(value, TIMESTAMP_FORMAT)
+
+
+def _format_timestamp(value: datetime) -> str:
+    """ Format a datetime in TIMESTAMP_FORMAT, with isoformat when it gives
+    the same result
+    """
+    if value.tzinfo is None and value.year >= 1000:
+        return value.isoformat(timespec='seconds')
+    return value.strftime(TIMESTAMP_FORMAT)
+
+
+def _in(value, values) -> bool:
+    """ Whether an attribute value is one of the filter values
+    """
+    return value in values
+
+
+def _startswith(value, prefix: str) -> bool:
+    """ Whether an attribute value is a string starting with a prefix
+    """
+    return type(value) is str and value.startswith(prefix)
+
+
+def _endswith(value, suffix: str) -> bool:
+    """ Whether an attribute value is a string ending with a suffix
+    """
+    return type(value) is str and value.endswith(suffix)
+
+
+def _isnull(value, null: bool) -> bool:
+    """ Whether an attribute value is None, or is not
+    """
+    return (value is None) is null
+
+
+# operators of Base.query, used as suffixes of the filtered attributes:
+# {"email__endswith": "@example.com", "created_at__gte": since}, as the
+# function testing the attribute value against the filter value. A
+# TypeError, such as comparing None or incomparable values, makes the
+# object not match
+OPERATORS = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "in": _in,
+    "startswith": _startswith,
+    "endswith": _endswith,
+    "lt": operator.lt,
+    "lte": operator.le,
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "isnull": _isnull,
+}
+
+
+class Event():
+    """ Change of the stored objects of a class, published to the
+    subscribers
+    - op: "create", "update" or "remove" of one object, "load" when all
+      objects of the class were loaded again
+    - cls: class of the objects
+    - id: ID of the object, None for "load"
+    - fields: names of the changed attributes, None when unknown or when
+      the whole object changed
+    """
+
+    __slots__ = ('op', 'cls', 'id', 'fields')
+
+    def __init__(self, op: str, cls: type, obj_id: str = None,
+                 fields: Tuple[str, ...] = None):
+        """ Initialize an Event
+        """
+        self.op = op
+        self.cls = cls
+        self.id = obj_id
+        self.fields = fields
+
+    def __repr__(self) -> str:
+        """ Representation of the event
+        """
+        return "Event({!r}, {}, {!r}, {!r})".format(
+            self.op, self.cls.__name__, self.id, self.fields)
+
+
+class Subscription():
+    """ Callback subscribed to the events matching its filters
+    """
+
+    __slots__ = ('callback', 'classes', 'ops', 'fields')
+
+    def __init__(self, callback: Callable[[Event], None],
+                 classes: Iterable[type] = None, ops: Iterable[str] = None,
+                 fields: Iterable[str] = None):
+        """ Initialize a Subscription, None filters matching everything
+        """
+        self.callback = callback
+        self.classes = tuple(classes) if classes is not None else None
+        self.ops = frozenset(ops) if ops is not None else None
+        self.fields = frozenset(fields) if fields is not None else None
+
+    def matches(self, event: Event) -> bool:
+        """ Whether the event passes the filters: of one of the classes or
+        their subclasses, one of the ops and changing one of the fields,
+        which unknown changed fields always may
+        """
+        if self.classes is not None and \
+                not issubclass(event.cls, self.classes):
+            return False
+        if self.ops is not None and event.op not in self.ops:
+            return False
+        if self.fields is not None and event.fields is not None and \
+                self.fields.isdisjoint(event.fields):
+            return False
+        return True
+
+
+# replaced rather than changed, so that publishing iterates without a
+# lock, and empty when nothing is subscribed so that changes only pay for
+# a truth test
+SUBSCRIBERS = ()
+_subscribers_lock = threading.Lock()
+_logger = logging.getLogger(__name__)
+
+
+def subscribe(callback: Callable[[Event], None],
+              classes: Iterable[type] = None, ops: Iterable[str] = None,
+              fields: Iterable[str] = None) -> Subscription:
+    """ Call `callback` with every matching Event, synchronously, right
+    after the change and in the order of the changes of each class
+    Args:
+        callback (callable): function of the Event
+        classes (list): only the events of these classes and subclasses
+        ops (list): only these ops
+        fields (list): only the events that may change these fields
+    Return:
+        the subscription, to be given to unsubscribe
+    """
+    global SUBSCRIBERS
+    subscription = Subscription(callback, classes, ops, fields)
+    with _subscribers_lock:
+        SUBSCRIBERS = SUBSCRIBERS + (subscription,)
+    return subscription
+
+
+def unsubscribe(subscription: Subscription):
+    """ Stop calling a subscribed callback
+    """
+    global SUBSCRIBERS
+    with _subscribers_lock:
+        SUBSCRIBERS = tuple(s for s in SUBSCRIBERS if s is not subscription)
+
+
+def publish(event: Event):
+    """ Call the subscribers matching an event. A failing subscriber is
+    logged and doesn't prevent the others from being called
+    """
+    for subscription in SUBSCRIBERS:
+        if subscription.matches(event):
+            try:
+                subscription.callback(event)
+            except Exception:
+                _logger.exception("subscriber failed on %r", event)
+
+
+def flush():
+    """ Save every class with pending write-behind changes
+    A class stays dirty until it is saved: when its save fails, the other
+    classes are still saved and the first error is raised at the end
+    """
+    with _flushing:
+        _flush_dirty()
+
+
+def _flush_dirty():
+    """ Save every dirty class, see flush()
+    """
+    with _flush_lock:
+        dirty = list(DIRTY.values())
+    error = None
+    for cls, writes in dirty:
+        # changes made during the save mark the class dirty again
+        with _flush_lock:
+            DIRTY.pop(cls.__name__, None)
+        try:
+            cls.save_to_file()
+        except Exception as e:
+            with _flush_lock:
+                pending = DIRTY.get(cls.__name__, (cls, 0))[1]
+                DIRTY[cls.__name__] = (cls, pending + writes)
+            if error is None:
+                error = e
+            continue
+        with _flush_lock:
+            FLUSH_STATS["flushes"] += 1
+            FLUSH_STATS["writes"] += writes
+            FLUSH_STATS["coalesced"] += writes - 1
+    if error is not None:
+        raise error
+
+
+def _flush_loop():
+    """ Body of the write-behind flusher thread
+    """
+    while True:
+        _flush_wakeup.wait(FLUSH_INTERVAL)
+        _flush_wakeup.clear()
+        requests = []
+        while _flush_requests:
+            requests.append(_flush_requests.pop())
+        try:
+            flush()
+        except Exception:
+            # the classes stay dirty, the next flush tries them again
+            _logger.exception("write-behind flush failed")
+        for request in requests:
+            request.set()
+
+
+def _flush_on_signal(signum, frame, previous=None):
+    """ Have the flusher thread save pending changes before handing a
+    signal to its handler. The signal may interrupt the main thread while
+    it holds the locks a flush takes, so the handler only waits for the
+    flusher, at most FLUSH_SIGNAL_TIMEOUT seconds
+    """
+    request = threading.Event()
+    _flush_requests.append(request)
+    _flush_wakeup.set()
+    request.wait(FLUSH_SIGNAL_TIMEOUT)
+    if callable(previous):
+        previous(signum, frame)
+    elif previous != signal.SIG_IGN:
+        raise SystemExit(128 + signum)
+
+
+def _start_flusher():
+    """ Start the write-behind flusher thread and the exit hooks once
+    """
+    global _flusher
+    with _flush_lock:
+        if _flusher is not None:
+            return
+        _flusher = threading.Thread(target=_flush_loop, daemon=True,
+                                    name="models-flusher")
+        _flusher.start()
+    atexit.register(flush)
+    try:
+        previous = signal.getsignal(signal.SIGTERM)
+        signal.signal(signal.SIGTERM,
+                      lambda s, f: _flush_on_signal(s, f, previous))
+    except ValueError:
+        # signal handlers can only be installed from the main thread
+        pass
 
 
 class Base():
     """ Base class
+    Changes to the objects of a class are serialized by a per-class lock.
+    Readers only take it to copy a chunk of the sorted IDs: otherwise they
+    use single dictionary lookups or iterate over a list copy of the
+    objects
     """
 
+    # instance attributes are declared in __slots__ rather than kept in a
+    # per-instance __dict__, which keeps millions of objects compact
+    __slots__ = ('id', 'created_at', 'updated_at', '_json_cache')
+
+    # attributes with a secondary index, used by search on equality
+    INDEXES = ()
+    # seconds after their creation objects expire, 0 if they never do,
+    # None if the class has no notion of expiry
+    EXPIRES_AFTER = None
+    STORAGE = STORAGE
+    WRITE_BEHIND = WRITE_BEHIND
+    LAZY_LOAD = LAZY_LOAD
+    COHERENT = COHERENT
+
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
         """
         s_class = str(self.__class__.__name__)
         if DATA.get(s_class) is None:
-            DATA[s_class] = {}
+            DATA.setdefault(s_class, {})
 
-        self.id = kwargs.get('id', str(uuid.uuid4()))
-        if kwargs.get('created_at') is not None:
-            self.created_at = datetime.strptime(kwargs.get('created_at'),
-                                                TIMESTAMP_FORMAT)
+        if 'id' in kwargs:
+            self.id = kwargs['id']
         else:
+            self.id = str(uuid.uuid4())
+        created_at = kwargs.get('created_at')
+        if created_at is None:
             self.created_at = datetime.utcnow()
-        if kwargs.get('updated_at') is not None:
-            self.updated_at = datetime.strptime(kwargs.get('updated_at'),
-                                                TIMESTAMP_FORMAT)
+        elif type(created_at) is datetime:
+            self.created_at = created_at
         else:
+            self.created_at = _parse_timestamp(created_at)
+        updated_at = kwargs.get('updated_at')
+        if updated_at is None:
             self.updated_at = datetime.utcnow()
+        elif type(updated_at) is datetime:
+            self.updated_at = updated_at
+        else:
+            self.updated_at = _parse_timestamp(updated_at)
 
     def __eq__(self, other: TypeVar('Base')) -> bool:
         """ Equality
@@ -44,82 +412,856 @@ class Base():
             return False
         return (self.id == other.id)
 
+    @classmethod
+    def fields(cls) -> tuple:
+        """ Declared attributes of the class, from Base down
+        """
+        fields = FIELDS.get(cls)
+        if fields is None:
+            fields = []
+            for klass in reversed(cls.__mro__):
+                for name in klass.__dict__.get('__slots__', ()):
+                    if name not in ('__dict__', '__weakref__') and \
+                            name not in TRANSIENT_FIELDS and \
+                            name not in fields:
+                        fields.append(name)
+            fields = FIELDS[cls] = tuple(fields)
+        return fields
+
+    @classmethod
+    def _serializer(cls, for_serialization: bool, native: bool = False):
+        """ Build once per class the function converting an object to a
+        JSON dictionary, with the attributes to output resolved up front
+        With `native`, timestamps are kept as datetime values
+        """
+        serializer = SERIALIZERS.get((cls, for_serialization, native))
+        if serializer is not None:
+            return serializer
+        names = tuple(name for name in cls.fields()
+                      if for_serialization or name[0] != '_')
+        getter = attrgetter(*names)
+
+        def serializer(obj: Base) -> dict:
+            try:
+                result = dict(zip(names, getter(obj)))
+            except AttributeError:
+                # some declared attributes are not set
+                result = {}
+                for name in names:
+                    try:
+                        result[name] = getattr(obj, name)
+                    except AttributeError:
+                        continue
+            for key, value in getattr(obj, '__dict__', {}).items():
+                if for_serialization or key[0] != '_':
+                    result[key] = value
+            if native:
+                return result
+            for key, value in result.items():
+                if type(value) is datetime:
+                    result[key] = _format_timestamp(value)
+            return result
+
+        SERIALIZERS[(cls, for_serialization, native)] = serializer
+        return serializer
+
+    @classmethod
+    def _state(cls) -> Callable:
+        """ Build once per class the function returning the attribute
+        values of an object, which its serialization is built from
+        """
+        state = STATES.get(cls)
+        if state is None:
+            getter = attrgetter(*cls.fields())
+            if cls.__dictoffset__:
+                def state(obj: Base) -> tuple:
+                    return getter(obj), tuple(obj.__dict__.items())
+            else:
+                state = getter
+            STATES[cls] = state
+        return state
+
     def to_json(self, for_serialization: bool = False) -> dict:
         """ Convert the object a JSON dictionary
+        The result is cached on stored objects along with the attribute
+        values it was built from, and built again once they change
         """
-        result = {}
-        for key, value in self.__dict__.items():
-            if not for_serialization and key[0] == '_':
-                continue
-            if type(value) is datetime:
-                result[key] = value.strftime(TIMESTAMP_FORMAT)
-            else:
-                result[key] = value
+        cache = getattr(self, '_json_cache', None)
+        try:
+            state = self.__class__._state()(self)
+        except AttributeError:
+            # some declared attributes are not set: nothing is cached
+            state = None
+        if cache is not None and state is not None:
+            cached = cache.get(for_serialization)
+            if cached is not None and cached[0] == state:
+                return dict(cached[1])
+        result = self.__class__._serializer(for_serialization)(self)
+        if state is not None and \
+                DATA.get(self.__class__.__name__, {}).get(self.id) is self:
+            if cache is None:
+                cache = self._json_cache = {}
+            elif for_serialization and True in cache and \
+                    SAVED_JSON not in cache:
+                # the attributes changed since the cached serialization
+                cache[SAVED_JSON] = cache[True][1]
+            cache[for_serialization] = (state, result)
+            return dict(result)
         return result
 
+    @classmethod
+    def _lock(cls) -> threading.RLock:
+        """ Lock serializing the changes to the objects of the class
+        """
+        lock = LOCKS.get(cls.__name__)
+        if lock is None:
+            with _locks_lock:
+                lock = LOCKS.setdefault(cls.__name__, threading.RLock())
+        return lock
+
+    @classmethod
+    def _storage(cls) -> Storage:
+        """ Storage backend of the class
+        """
+        return get_storage(cls.STORAGE)
+
     @classmethod
     def load_from_file(cls):
-        """ Load all objects from file
+        """ Load all objects from file, then replay the journal
+        With LAZY_LOAD, objects are only built on first access.
+        Readers keep seeing the previous objects until the load is done
+        """
+        s_class = cls.__name__
+        with cls._lock():
+            if cls._coherent():
+                # under the inter-process lock, so that no snapshot is
+                # read halfway through its compaction
+                with cls._storage().lock(cls):
+                    SYNC[s_class] = (cls._storage().token(cls),
+                                     time.monotonic())
+                    objs_json = cls._storage().load(cls)
+            else:
+                objs_json = cls._storage().load(cls)
+            data, lazy = {}, {}
+            if cls.LAZY_LOAD:
+                lazy = objs_json
+            else:
+                for obj_id, obj_json in objs_json.items():
+                    data[obj_id] = cls(**obj_json)
+            LAZY[s_class] = lazy
+            DATA[s_class] = data
+            ORDER.pop(s_class, None)
+            if cls.LAZY_LOAD or cls._storage().queryable:
+                # objects are indexed as they are built, a queryable
+                # storage reads them on demand with its own indexes
+                INDEX[s_class] = {}
+                INDEX_KEYS[s_class] = {}
+                EXPIRY.pop(s_class, None)
+                if cls.EXPIRES_AFTER:
+                    for obj_json in lazy.values():
+                        cls._track_expiry_json(obj_json)
+            else:
+                cls._reindex()
+            if SUBSCRIBERS:
+                publish(Event("load", cls))
+
+    @classmethod
+    def _coherent(cls) -> bool:
+        """ Whether the class stays coherent with other processes
+        """
+        return cls.COHERENT and not cls._write_behind()
+
+    @classmethod
+    def _write_behind(cls) -> bool:
+        """ Whether the changes of the class are saved in the background
+        """
+        return cls.WRITE_BEHIND and not cls._storage().queryable
+
+    @classmethod
+    def sync(cls, force: bool = False):
+        """ Catch up with the changes other processes wrote to the storage
+        of the class: replay them when the storage can read them one by
+        one, reload everything otherwise
+        Args:
+            force (bool): check the storage even if it was checked less
+                than COHERENCE_INTERVAL seconds ago
+        """
+        if not cls._coherent():
+            return
+        s_class = cls.__name__
+        state = SYNC.get(s_class)
+        if not force and state is not None \
+                and time.monotonic() - state[1] < COHERENCE_INTERVAL:
+            return
+        start = time.perf_counter()
+        reloaded = replayed = 0
+        with cls._lock():
+            state = SYNC.get(s_class)
+            token, changes = cls._storage().changes(
+                cls, state[0] if state is not None else None)
+            if changes is None:
+                reloaded = 1
+                if cls._storage().queryable:
+                    cls._forget()
+                    SYNC[s_class] = (token, time.monotonic())
+                    if SUBSCRIBERS:
+                        publish(Event("load", cls))
+                else:
+                    cls.load_from_file()
+            else:
+                replayed = len(changes)
+                cls._apply(changes)
+                SYNC[s_class] = (token, time.monotonic())
+        with _flush_lock:
+            COHERENCE_STATS["checks"] += 1
+            COHERENCE_STATS["reloads"] += reloaded
+            COHERENCE_STATS["replayed"] += replayed
+            COHERENCE_STATS["check_seconds"] += time.perf_counter() - start
+
+    @classmethod
+    def _forget(cls):
+        """ Forget the stored objects of a queryable storage, which are
+        read on demand
         """
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
         DATA[s_class] = {}
-        if not path.exists(file_path):
+        ORDER.pop(s_class, None)
+        INDEX[s_class] = {}
+        INDEX_KEYS[s_class] = {}
+        EXPIRY.pop(s_class, None)
+
+    @classmethod
+    def _apply(cls, changes: List[tuple]):
+        """ Apply the changes read from the storage to the stored objects
+        """
+        s_class = cls.__name__
+        data = DATA.setdefault(s_class, {})
+        for op, value in changes:
+            obj_id = value['id'] if op == "put" else value
+            existed = obj_id in data or obj_id in LAZY.get(s_class, {})
+            LAZY.get(s_class, {}).pop(obj_id, None)
+            cls._unindex(obj_id)
+            if op == "put":
+                obj = cls(**value)
+                cls._store(obj)
+                cls._index(obj)
+                cls._order_add(obj_id)
+                if SUBSCRIBERS:
+                    publish(Event("update" if existed else "create", cls,
+                                  obj_id))
+            elif data.pop(obj_id, None) is not None:
+                cls._order_remove(obj_id)
+                if SUBSCRIBERS:
+                    publish(Event("remove", cls, obj_id))
+
+    @classmethod
+    @contextmanager
+    def _writing(cls) -> Iterator[None]:
+        """ Hold the lock of the class for a change and, when coherent,
+        the inter-process lock of its storage after catching up with the
+        other processes
+        """
+        s_class = cls.__name__
+        with cls._lock():
+            if not cls._coherent() or s_class in WRITING:
+                yield
+                return
+            start = time.perf_counter()
+            with cls._storage().lock(cls):
+                with _flush_lock:
+                    COHERENCE_STATS["lock_seconds"] += \
+                        time.perf_counter() - start
+                cls.sync(force=True)
+                WRITING.add(s_class)
+                try:
+                    yield
+                finally:
+                    WRITING.discard(s_class)
+                    # our own changes are not ones to catch up with
+                    SYNC[s_class] = (cls._storage().token(cls),
+                                     time.monotonic())
+
+    @classmethod
+    def _hydrate(cls, obj_id: str) -> TypeVar('Base'):
+        """ Build one lazily loaded object, or read it from a queryable
+        storage, and store it
+        """
+        s_class = cls.__name__
+        with cls._lock():
+            obj = DATA[s_class].get(obj_id)
+            if obj is not None:
+                return obj
+            obj_json = LAZY.get(s_class, {}).pop(obj_id, None)
+            if obj_json is None and cls._storage().queryable:
+                obj_json = cls._storage().get(cls, obj_id)
+            if obj_json is None:
+                return None
+            return cls._cache(obj_json)
+
+    @classmethod
+    def _cache(cls, obj_json: dict) -> TypeVar('Base'):
+        """ Build an object read from storage and store it, keeping the
+        object already stored with the same ID if any
+        """
+        s_class = cls.__name__
+        with cls._lock():
+            obj = DATA[s_class].get(obj_json['id'])
+            if obj is None:
+                obj = cls(**obj_json)
+                cls._store(obj)
+                cls._index(obj)
+            return obj
+
+    @classmethod
+    def _store(cls, obj: TypeVar('Base')):
+        """ Store an object, as the most recent one. With a queryable
+        storage, drop the least recent objects beyond CACHE_SIZE: they are
+        read again from storage when needed
+        """
+        data = DATA[cls.__name__]
+        if not cls._storage().queryable:
+            data[obj.id] = obj
             return
+        data.pop(obj.id, None)
+        data[obj.id] = obj
+        while len(data) > max(CACHE_SIZE, 1):
+            del data[next(iter(data))]
 
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+    @classmethod
+    def _scan(cls) -> List[TypeVar('Base')]:
+        """ Read every object of a queryable storage, without storing the
+        objects not stored yet
+        """
+        data = DATA[cls.__name__]
+        return [data.get(obj_json['id']) or cls(**obj_json)
+                for obj_json in cls._storage().search(cls, {})]
+
+    @classmethod
+    def _hydrate_all(cls):
+        """ Build every lazily loaded object, or read every object from a
+        queryable storage, beyond CACHE_SIZE, before converting it
+        """
+        s_class = cls.__name__
+        if cls._storage().queryable:
+            with cls._lock():
+                data = DATA[s_class]
+                for obj_json in cls._storage().search(cls, {}):
+                    if obj_json['id'] not in data:
+                        data[obj_json['id']] = cls(**obj_json)
+            return
+        if not LAZY.get(s_class):
+            return
+        with cls._lock():
+            pending = LAZY.get(s_class, {})
+            for obj_id, obj_json in list(pending.items()):
+                if obj_id not in DATA[s_class]:
+                    obj = cls(**obj_json)
+                    DATA[s_class][obj_id] = obj
+                    cls._index(obj)
+                del pending[obj_id]
 
     @classmethod
     def save_to_file(cls):
         """ Save all objects to file
+        In journal storage, the file is a snapshot: it is replaced
+        atomically and the journal it covers is emptied
         """
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        objs_json = {}
-        for obj_id, obj in DATA[s_class].items():
-            objs_json[obj_id] = obj.to_json(True)
+        with cls._writing():
+            objs_json = {}
+            if cls._storage().queryable:
+                # only some objects are stored in memory
+                objs_json = {obj_json['id']: obj_json for obj_json in
+                             cls._storage().search(cls, {})}
+            else:
+                cls._hydrate_all()
+            if cls._storage().native_timestamps:
+                serializer = cls._serializer(True, native=True)
+                for obj_id, obj in list(DATA[s_class].items()):
+                    objs_json[obj_id] = serializer(obj)
+            else:
+                for obj_id, obj in list(DATA[s_class].items()):
+                    objs_json[obj_id] = obj.to_json(True)
+            cls._storage().dump(cls, objs_json)
 
-        with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+    @classmethod
+    def convert_storage(cls, storage: str):
+        """ Copy all objects to another storage backend, such as from the
+        JSON "file" storage to the "binary" one or back, and use it from
+        now on
+        Args:
+            storage (str): name of the storage backend to convert to
+        """
+        with cls._writing():
+            if cls.__name__ not in DATA:
+                cls.load_from_file()
+            cls._hydrate_all()
+            cls.STORAGE = storage
+            cls.save_to_file()
+            ORDER.pop(cls.__name__, None)
+            if cls._storage().queryable:
+                cls._forget()
+            else:
+                cls._reindex()
+
+    @classmethod
+    def _persist(cls, obj: TypeVar('Base'), removed: bool = False):
+        """ Persist the change of an object according to the storage mode
+        of the class
+        """
+        cls._persist_many([obj], removed)
+
+    @classmethod
+    def _persist_many(cls, objs: List[TypeVar('Base')],
+                      removed: bool = False):
+        """ Persist the changes of several objects at once according to
+        the storage mode of the class
+        """
+        if not objs:
+            return
+        if cls._write_behind():
+            with _flush_lock:
+                writes = DIRTY.get(cls.__name__, (cls, 0))[1] + len(objs)
+                DIRTY[cls.__name__] = (cls, writes)
+                pending = sum(w for _, w in DIRTY.values())
+            if _flusher is None:
+                _start_flusher()
+            if pending >= FLUSH_THRESHOLD:
+                _flush_wakeup.set()
+        elif not cls._storage().incremental:
+            cls.save_to_file()
+        elif removed:
+            cls._storage().delete_many(cls, [obj.id for obj in objs])
+        else:
+            cls._storage().put_many(cls, [obj.to_json(True) for obj in objs])
 
     def save(self):
         """ Save current object
         """
         s_class = self.__class__.__name__
-        self.updated_at = datetime.utcnow()
-        DATA[s_class][self.id] = self
-        self.__class__.save_to_file()
+        with self.__class__._writing():
+            before = self._before_save() if SUBSCRIBERS else None
+            self._json_cache = None
+            self.updated_at = datetime.utcnow()
+            LAZY.get(s_class, {}).pop(self.id, None)
+            self.__class__._unindex(self.id)
+            self.__class__._store(self)
+            self.__class__._index(self)
+            self.__class__._order_add(self.id)
+            self.__class__._persist(self)
+            if before is not None:
+                self._publish_save(before)
+
+    def _before_save(self) -> tuple:
+        """ State of the object before a save, to tell what it changed:
+        whether it was stored and its last serialization, if cached
+        """
+        s_class = self.__class__.__name__
+        stored = self.id in DATA[s_class] or self.id in LAZY.get(s_class, {})
+        if not stored and self.__class__._storage().queryable:
+            stored = self.__class__._storage().get(
+                self.__class__, self.id) is not None
+        cache = getattr(self, '_json_cache', None) or {}
+        if SAVED_JSON in cache:
+            return stored, cache[SAVED_JSON]
+        return stored, cache[True][1] if True in cache else None
+
+    def _publish_save(self, before: tuple):
+        """ Publish the creation or the update of the object, with the
+        attributes that changed since its last serialization
+        """
+        stored, previous = before
+        if not stored:
+            publish(Event("create", self.__class__, self.id,
+                          self.__class__.fields()))
+            return
+        fields = None
+        if previous is not None:
+            current = self.to_json(True)
+            fields = tuple(k for k in current
+                           if k not in previous or previous[k] != current[k])
+            fields += tuple(k for k in previous if k not in current)
+        publish(Event("update", self.__class__, self.id, fields))
+
+    @classmethod
+    def save_many(cls, objs: Iterable[TypeVar('Base')]):
+        """ Save several objects of the class, persisting them at once
+        """
+        objs = list(objs)
+        for obj in objs:
+            if type(obj) is not cls:
+                raise TypeError("{} is not a {}".format(
+                    type(obj).__name__, cls.__name__))
+        s_class = cls.__name__
+        with cls._writing():
+            befores = [obj._before_save() for obj in objs] \
+                if SUBSCRIBERS else None
+            now = datetime.utcnow()
+            lazy = LAZY.get(s_class, {})
+            for obj in objs:
+                obj._json_cache = None
+                obj.updated_at = now
+                lazy.pop(obj.id, None)
+                cls._unindex(obj.id)
+                cls._store(obj)
+                cls._index(obj)
+                cls._order_add(obj.id)
+            cls._persist_many(objs)
+            if befores is not None:
+                for obj, before in zip(objs, befores):
+                    obj._publish_save(before)
+
+    @classmethod
+    def remove_many(cls, ids: Iterable[str]) -> int:
+        """ Remove several objects of the class by ID, persisting the
+        removals at once
+        Return:
+            the number of objects removed
+        """
+        s_class = cls.__name__
+        with cls._writing():
+            removed = []
+            for obj_id in ids:
+                obj = cls._hydrate(obj_id)
+                if obj is None:
+                    continue
+                cls._unindex(obj_id)
+                del DATA[s_class][obj_id]
+                cls._order_remove(obj_id)
+                removed.append(obj)
+            cls._persist_many(removed, removed=True)
+            if SUBSCRIBERS:
+                for obj in removed:
+                    publish(Event("remove", cls, obj.id))
+        return len(removed)
 
     def remove(self):
         """ Remove object
         """
         s_class = self.__class__.__name__
-        if DATA[s_class].get(self.id) is not None:
-            del DATA[s_class][self.id]
-            self.__class__.save_to_file()
+        with self.__class__._writing():
+            self.__class__._hydrate(self.id)
+            if DATA[s_class].get(self.id) is not None:
+                self.__class__._unindex(self.id)
+                del DATA[s_class][self.id]
+                self.__class__._order_remove(self.id)
+                self.__class__._persist(self, removed=True)
+                if SUBSCRIBERS:
+                    publish(Event("remove", self.__class__, self.id))
+
+    @classmethod
+    def _index(cls, obj: TypeVar('Base')):
+        """ Add a stored object to the secondary indexes, only tracking
+        its expiry with a queryable storage, which has its own indexes
+        """
+        s_class = cls.__name__
+        if cls._storage().queryable:
+            if cls.EXPIRES_AFTER:
+                cls._track_expiry(obj.id, obj.created_at)
+            return
+        indexes = INDEX.setdefault(s_class, {})
+        keys = {}
+        for attr in cls.INDEXES:
+            value = getattr(obj, attr, None)
+            try:
+                bucket = indexes.setdefault(attr, {}).setdefault(value, {})
+            except TypeError:
+                continue
+            bucket[obj.id] = obj
+            keys[attr] = value
+        INDEX_KEYS.setdefault(s_class, {})[obj.id] = keys
+        if cls.EXPIRES_AFTER:
+            cls._track_expiry(obj.id, obj.created_at)
+
+    @classmethod
+    def _unindex(cls, obj_id: str):
+        """ Remove a stored object from the secondary indexes, using the
+        values it was indexed with
+        """
+        s_class = cls.__name__
+        if cls.EXPIRES_AFTER and s_class in EXPIRY:
+            EXPIRY[s_class]["active"].pop(obj_id, None)
+            EXPIRY[s_class]["expired"].discard(obj_id)
+        keys = INDEX_KEYS.get(s_class, {}).pop(obj_id, None)
+        if keys is None:
+            return
+        indexes = INDEX[s_class]
+        for attr, value in keys.items():
+            bucket = indexes[attr][value]
+            bucket.pop(obj_id, None)
+            if not bucket:
+                del indexes[attr][value]
+
+    @classmethod
+    def _reindex(cls):
+        """ Rebuild the secondary indexes from the stored objects
+        """
+        with cls._lock():
+            cls._hydrate_all()
+            INDEX[cls.__name__] = {}
+            INDEX_KEYS[cls.__name__] = {}
+            EXPIRY.pop(cls.__name__, None)
+            for obj in list(DATA.get(cls.__name__, {}).values()):
+                cls._index(obj)
+
+    @classmethod
+    def _track_expiry(cls, obj_id: str, created_at: datetime):
+        """ Count a stored object as active until it expires, or as
+        expired
+        """
+        state = EXPIRY.setdefault(cls.__name__, {
+            "heap": [], "active": {}, "expired": set()})
+        expires_at = (created_at - EPOCH).total_seconds() + \
+            cls.EXPIRES_AFTER
+        if expires_at <= (datetime.utcnow() - EPOCH).total_seconds():
+            state["expired"].add(obj_id)
+            return
+        state["active"][obj_id] = expires_at
+        heapq.heappush(state["heap"], (expires_at, obj_id))
+
+    @classmethod
+    def _track_expiry_json(cls, obj_json: dict):
+        """ Track the expiry of an object not built yet, from its JSON
+        dictionary
+        """
+        created_at = obj_json.get('created_at')
+        if type(created_at) is str:
+            created_at = _parse_timestamp(created_at)
+        if created_at is not None:
+            cls._track_expiry(obj_json['id'], created_at)
+
+    @classmethod
+    def _seed_expiry(cls):
+        """ Track the expiry of every object of a queryable storage, which
+        are not all stored in memory, by reading them once page by page.
+        Saves and removals keep it up to date until a reload from storage
+        """
+        with cls._lock():
+            EXPIRY.pop(cls.__name__, None)
+            after = None
+            while True:
+                rows = cls._storage().page(cls, after, STORAGE_PAGE_SIZE)
+                for obj_json in rows:
+                    cls._track_expiry_json(obj_json)
+                if len(rows) < STORAGE_PAGE_SIZE:
+                    break
+                after = rows[-1]['id']
+            EXPIRY.setdefault(cls.__name__, {
+                "heap": [], "active": {}, "expired": set()})["seeded"] = True
+
+    @classmethod
+    def _expiry_counts(cls) -> Tuple[int, int]:
+        """ Move the objects which expired since the last call from the
+        active ones to the expired ones, in expiry order, and count both
+        """
+        state = EXPIRY.get(cls.__name__)
+        if cls._storage().queryable and \
+                (state is None or not state.get("seeded")):
+            cls._seed_expiry()
+            state = EXPIRY.get(cls.__name__)
+        if state is None:
+            return 0, 0
+        heap, active, expired = state["heap"], state["active"], \
+            state["expired"]
+        now = (datetime.utcnow() - EPOCH).total_seconds()
+        with cls._lock():
+            while heap and heap[0][0] <= now:
+                expires_at, obj_id = heapq.heappop(heap)
+                # skip entries of objects since removed or saved again
+                if active.get(obj_id) == expires_at:
+                    del active[obj_id]
+                    expired.add(obj_id)
+            if len(heap) > 2 * len(active) + 64:
+                state["heap"] = [(v, k) for k, v in active.items()]
+                heapq.heapify(state["heap"])
+        return len(active), len(expired)
+
+    @classmethod
+    def models(cls) -> List[type]:
+        """ Return the model classes derived from the class
+        """
+        models = []
+        for subclass in cls.__subclasses__():
+            models.append(subclass)
+            models.extend(subclass.models())
+        return models
+
+    @classmethod
+    def stats(cls) -> dict:
+        """ Counters of the class, kept up to date as objects are saved,
+        removed and expire rather than computed by scanning them
+        With a queryable storage such as SQLite, the active and expired
+        objects are counted by reading every object once, on the first
+        call and again after each reload from storage, and the count of
+        a class without EXPIRES_AFTER is a COUNT query on its table
+        Return:
+            the number of objects in `count`, the size in bytes of the
+            stored objects in `bytes` (None if unknown) and, for classes
+            with an EXPIRES_AFTER, the number of `active` and `expired`
+            objects
+        """
+        if cls.__name__ not in DATA:
+            cls.load_from_file()
+        stats = {}
+        if cls.EXPIRES_AFTER and cls._storage().queryable:
+            cls.sync()
+            active, expired = cls._expiry_counts()
+            # every stored object is either active or expired
+            stats["count"] = active + expired
+        else:
+            stats["count"] = cls.count()
+        stats["bytes"] = cls._storage().size(cls)
+        if cls.EXPIRES_AFTER:
+            if not cls._storage().queryable:
+                active, expired = cls._expiry_counts()
+            stats["active"], stats["expired"] = active, expired
+        elif cls.EXPIRES_AFTER is not None:
+            stats["active"], stats["expired"] = stats["count"], 0
+        return stats
 
     @classmethod
     def count(cls) -> int:
         """ Count all objects
         """
         s_class = cls.__name__
-        return len(DATA[s_class].keys())
+        cls.sync()
+        if cls._storage().queryable:
+            return cls._storage().count(cls)
+        return len(DATA[s_class].keys()) + len(LAZY.get(s_class, {}))
 
     @classmethod
     def all(cls) -> Iterable[TypeVar('Base')]:
         """ Return all objects
         """
-        return cls.search()
+        cls.sync()
+        if cls._storage().queryable:
+            return cls.search()
+        cls._hydrate_all()
+        return list(DATA[cls.__name__].values())
+
+    @classmethod
+    def _order(cls) -> List[str]:
+        """ Sorted IDs of the stored objects, built on first use and then
+        kept up to date in place by save() and remove(), so that readers
+        copy what they need of it under the lock. Not used with a
+        queryable storage, which pages through its own order
+        """
+        s_class = cls.__name__
+        order = ORDER.get(s_class)
+        if order is None:
+            with cls._lock():
+                order = ORDER.get(s_class)
+                if order is None:
+                    order = sorted(set(DATA[s_class]) |
+                                   set(LAZY.get(s_class, {})))
+                    ORDER[s_class] = order
+        return order
+
+    @classmethod
+    def _order_add(cls, obj_id: str):
+        """ Insert an ID in the sorted IDs, if they are built
+        """
+        order = ORDER.get(cls.__name__)
+        if order is not None:
+            i = bisect_left(order, obj_id)
+            if i == len(order) or order[i] != obj_id:
+                order.insert(i, obj_id)
+
+    @classmethod
+    def _order_remove(cls, obj_id: str):
+        """ Remove an ID from the sorted IDs, if they are built
+        """
+        order = ORDER.get(cls.__name__)
+        if order is not None:
+            i = bisect_left(order, obj_id)
+            if i < len(order) and order[i] == obj_id:
+                del order[i]
+
+    @classmethod
+    def iterate(cls, after: str = None) -> Iterator[TypeVar('Base')]:
+        """ Iterate over all objects in ID order, copying their IDs a
+        chunk at a time
+        Objects saved meanwhile may be missed, objects removed meanwhile
+        are skipped
+        Args:
+            after (str): only yield objects with a greater ID
+        """
+        cls.sync()
+        if cls._storage().queryable:
+            while True:
+                objs = cls._page(after, STORAGE_PAGE_SIZE)
+                yield from objs
+                if len(objs) < STORAGE_PAGE_SIZE:
+                    return
+                after = objs[-1].id
+        while True:
+            with cls._lock():
+                order = cls._order()
+                i = 0 if after is None else bisect_right(order, after)
+                ids = order[i:i + STORAGE_PAGE_SIZE]
+            for obj_id in ids:
+                obj = cls._get(obj_id)
+                if obj is not None:
+                    yield obj
+            if len(ids) < STORAGE_PAGE_SIZE:
+                return
+            after = ids[-1]
+
+    @classmethod
+    def page(cls, limit: int,
+             cursor: str = None) -> Tuple[List[TypeVar('Base')],
+                                          Optional[str]]:
+        """ Return one page of objects in ID order
+        Args:
+            limit (int): maximum number of objects in the page
+            cursor (str): cursor returned with the previous page, None for
+                the first page
+        Return:
+            the objects and the cursor of the next page, None if there is
+            no next page
+        """
+        if cls._storage().queryable:
+            cls.sync()
+            # one more object tells whether there is a next page
+            objs = cls._page(cursor, limit + 1)
+            if len(objs) > limit:
+                return objs[:limit], objs[limit - 1].id
+            return objs, None
+        objs = []
+        for obj in cls.iterate(cursor):
+            if len(objs) == limit:
+                return objs, objs[-1].id
+            objs.append(obj)
+        return objs, None
+
+    @classmethod
+    def _page(cls, after: Optional[str],
+              limit: int) -> List[TypeVar('Base')]:
+        """ Read one page of objects in ID order from a queryable storage
+        and store them, under the lock so that no object removed
+        meanwhile is stored again
+        """
+        with cls._lock():
+            return [cls._cache(obj_json) for obj_json in
+                    cls._storage().page(cls, after, limit)]
 
     @classmethod
     def get(cls, id: str) -> TypeVar('Base'):
         """ Return one object by ID
         """
+        cls.sync()
+        return cls._get(id)
+
+    @classmethod
+    def _get(cls, id: str) -> TypeVar('Base'):
+        """ Return one object by ID, without catching up with other
+        processes
+        """
         s_class = cls.__name__
-        return DATA[s_class].get(id)
+        obj = DATA[s_class].get(id)
+        if obj is None and (LAZY.get(s_class) or cls._storage().queryable):
+            obj = cls._hydrate(id)
+        return obj
 
     @classmethod
     def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
@@ -133,5 +1275,183 @@ class Base():
                 if (getattr(obj, k) != v):
                     return False
             return True
-        
-        return list(filter(_search, DATA[s_class].values()))
+
+        cls.sync()
+        if cls._storage().queryable:
+            rows = cls._storage().search(cls, attributes)
+            if rows is None:
+                return list(filter(_search, cls._scan()))
+            objs = [DATA[s_class].get(row['id']) or cls._cache(row)
+                    for row in rows]
+            return list(filter(_search, objs))
+        cls._hydrate_all()
+        objs = list(DATA[s_class].values())
+        indexes = INDEX.get(s_class, {})
+        for k, v in attributes.items():
+            if k in cls.INDEXES and k in indexes:
+                try:
+                    objs = list(indexes[k].get(v, {}).values())
+                except TypeError:
+                    continue
+                break
+        return list(filter(_search, objs))
+
+    @classmethod
+    def _compile_query(cls, shape: tuple, order: tuple) -> tuple:
+        """ Build once per query shape the function binding the filter
+        values to a selection generator, and the sort key of the results.
+        The shape is compiled to the getter and the operator function of
+        each filter, which are bound to the filter values at query time
+        Args:
+            shape (tuple): (attribute, operator) pairs of the filters
+            order (tuple): (attribute, descending) pairs of the ordering
+        Return:
+            the binding function, the sort key or None and whether the
+            key sorts in reverse
+        """
+        compiled = QUERIES.get((cls, shape, order))
+        if compiled is not None:
+            return compiled
+        tests = tuple((attrgetter(attr), OPERATORS[op])
+                      for attr, op in shape)
+
+        def bind(values: tuple) -> Optional[Callable]:
+            if not tests:
+                return None
+            conditions = tuple((get, test, value) for (get, test), value
+                               in zip(tests, values))
+
+            def select(objs: Iterable[Base]) -> Iterator[Base]:
+                for obj in objs:
+                    try:
+                        for get, test, value in conditions:
+                            try:
+                                x = get(obj)
+                            except AttributeError:
+                                x = None
+                            if not test(x, value):
+                                break
+                        else:
+                            yield obj
+                    except TypeError:
+                        continue
+            return select
+
+        def field_key(attr: str, descending: bool) -> Callable:
+            # None values always come last
+            if descending:
+                def key(obj: Base) -> tuple:
+                    value = getattr(obj, attr, None)
+                    return (value is not None, value)
+            else:
+                def key(obj: Base) -> tuple:
+                    value = getattr(obj, attr, None)
+                    return (value is None, value)
+            return key
+
+        keys = tuple((field_key(attr, descending), descending)
+                     for attr, descending in order)
+        key, reverse = None, False
+        if len(set(descending for _, descending in keys)) == 1:
+            reverse = keys[0][1]
+            if len(keys) == 1:
+                key = keys[0][0]
+            else:
+                def key(obj: Base) -> tuple:
+                    return tuple(k(obj) for k, _ in keys)
+        elif keys:
+            def compare(a: Base, b: Base) -> int:
+                for k, descending in keys:
+                    key_a, key_b = k(a), k(b)
+                    if key_a != key_b:
+                        result = -1 if key_a < key_b else 1
+                        return -result if descending else result
+                return 0
+            key = cmp_to_key(compare)
+        compiled = QUERIES[(cls, shape, order)] = (bind, key, reverse)
+        return compiled
+
+    @classmethod
+    def _candidates(cls, shape: tuple, values: tuple) -> List[TypeVar('Base')]:
+        """ Objects a query has to test: read from a queryable storage with
+        the equality filters, else the smallest set given by an equality
+        or `in` filter on the ID or an indexed attribute, else all objects
+        """
+        s_class = cls.__name__
+        if cls._storage().queryable:
+            rows = cls._storage().search(cls, {
+                attr: value for (attr, op), value in zip(shape, values)
+                if op == "eq"})
+            if rows is None:
+                return cls._scan()
+            return [DATA[s_class].get(row['id']) or cls._cache(row)
+                    for row in rows]
+        cls._hydrate_all()
+        data = DATA[s_class]
+        indexes = INDEX.get(s_class, {})
+        best = None
+        for (attr, op), value in zip(shape, values):
+            if op not in ("eq", "in"):
+                continue
+            keys = (value,) if op == "eq" else value
+            try:
+                if attr == 'id':
+                    objs = [data[k] for k in keys if k in data]
+                elif attr in cls.INDEXES and attr in indexes:
+                    objs = [obj for k in keys
+                            for obj in indexes[attr].get(k, {}).values()]
+                else:
+                    continue
+            except TypeError:
+                continue
+            if best is None or len(objs) < len(best):
+                best = objs
+        return best if best is not None else list(data.values())
+
+    @classmethod
+    def query(cls, filters: dict = None, order_by: Iterable[str] = None,
+              limit: int = None) -> List[TypeVar('Base')]:
+        """ Search objects with operators, ordering and a limit
+        Args:
+            filters (dict): values by attribute, suffixed by an operator of
+                OPERATORS after a double underscore, "eq" by default
+            order_by (str or list): attributes to order by, prefixed by
+                "-" for a descending order
+            limit (int): maximum number of objects, the top ones when
+                ordered
+        Return:
+            the matching objects
+        """
+        shape, values = [], []
+        for name, value in (filters or {}).items():
+            attr, sep, op = name.rpartition('__')
+            if not sep or not attr:
+                attr, op = name, "eq"
+            elif op not in OPERATORS:
+                raise ValueError("unknown operator: {}".format(op))
+            if op == "isnull":
+                value = bool(value)
+            elif op == "in":
+                try:
+                    value = frozenset(value)
+                except TypeError:
+                    value = tuple(value)
+            shape.append((attr, op))
+            values.append(value)
+        if isinstance(order_by, str):
+            order_by = (order_by,)
+        order = tuple((f[1:], True) if f.startswith('-') else (f, False)
+                      for f in order_by or ())
+        bind, key, reverse = cls._compile_query(tuple(shape), order)
+        cls.sync()
+        objs = cls._candidates(tuple(shape), tuple(values))
+        select = bind(tuple(values))
+        if select is not None:
+            objs = select(objs)
+        if key is None:
+            return list(objs if limit is None else islice(objs, limit))
+        if limit is None:
+            return sorted(objs, key=key, reverse=reverse)
+        if reverse:
+            return heapq.nlargest(limit, objs, key=key)
+        return heapq.nsmallest(limit, objs, key=key)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+""" Concurrent stress test of the models
+Writer threads save and remove users while reader threads search, list
+and page through them, on each storage backend. Run it from the project
+directory with:
+    python3 -m unittest models.test_concurrency
+"""
+from os import getenv
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from models import base
+from models.user import User
+
+
+WRITERS = int(getenv("MODELS_STRESS_WRITERS", 6))
+READERS = int(getenv("MODELS_STRESS_READERS", 4))
+OPERATIONS = int(getenv("MODELS_STRESS_OPERATIONS", 100))
+SWITCH_INTERVAL = float(getenv("MODELS_STRESS_SWITCH_INTERVAL", 0.0001))
+
+
+class TestConcurrency(unittest.TestCase):
+    """ Writers and readers sharing the User store
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Run in a scratch directory, as the storages use relative paths
+        """
+        cls.cwd = os.getcwd()
+        cls.tmp = tempfile.mkdtemp()
+        os.chdir(cls.tmp)
+        cls.storage = User.STORAGE
+        cls.lazy_load = User.LAZY_LOAD
+        # switch threads more often, for more interleavings and so that
+        # the readers do not keep the writers waiting for the GIL
+        cls.interval = sys.getswitchinterval()
+        sys.setswitchinterval(SWITCH_INTERVAL)
+
+    @classmethod
+    def tearDownClass(cls):
+        """ Restore the working directory, the storage and loading of User
+        and the thread switch interval
+        """
+        User.STORAGE = cls.storage
+        User.LAZY_LOAD = cls.lazy_load
+        sys.setswitchinterval(cls.interval)
+        os.chdir(cls.cwd)
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def run_stress(self, storage: str, lazy_load: bool = False):
+        """ Run the writers and readers on a storage backend, then check
+        that the objects, the index, the order and the storage agree
+        """
+        User.STORAGE = storage
+        User.LAZY_LOAD = lazy_load
+        User.load_from_file()
+        User.remove_many([user.id for user in User.all()])
+        errors = []
+        kept = [set() for _ in range(WRITERS)]
+        done = threading.Event()
+
+        def writer(n: int):
+            """ Save new users, update and remove some of them
+            """
+            rand = random.Random(n)
+            mine = []
+            try:
+                for i in range(OPERATIONS):
+                    choice = rand.random()
+                    if mine and choice < 0.2:
+                        user = mine.pop(rand.randrange(len(mine)))
+                        user.remove()
+                        kept[n].discard(user.id)
+                    elif mine and choice < 0.4:
+                        user = rand.choice(mine)
+                        user.first_name = "updated {}".format(i)
+                        user.save()
+                    else:
+                        user = User(email="w{}-{}@example.com".format(n, i),
+                                    first_name="writer {}".format(n))
+                        user.save()
+                        mine.append(user)
+                        kept[n].add(user.id)
+            except Exception as e:
+                errors.append(e)
+
+        def reader():
+            """ Search, list and page through the users, checking what
+            each call returns
+            """
+            try:
+                while not done.is_set():
+                    email = "w0-{}@example.com".format(
+                        random.randrange(OPERATIONS))
+                    for user in User.search({"email": email}):
+                        assert user.email == email, user.email
+                    ids = [user.id for user in User.all()]
+                    assert len(ids) == len(set(ids)), "duplicate in all()"
+                    cursor, seen = None, []
+                    while True:
+                        users, cursor = User.page(50, cursor)
+                        seen.extend(user.id for user in users)
+                        if cursor is None:
+                            break
+                    assert all(a < b for a, b in zip(seen, seen[1:])), \
+                        "page() repeated or misordered an ID"
+                    User.count()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=writer, args=(n,))
+                   for n in range(WRITERS)]
+        readers = [threading.Thread(target=reader) for _ in range(READERS)]
+        for thread in readers + threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        done.set()
+        for thread in readers:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        expected = set().union(*kept)
+        users = {user.id: user for user in User.all()}
+        self.assertEqual(set(users), expected)
+        self.assertEqual(User.count(), len(expected))
+        self.assertEqual([user.id for user in User.iterate()],
+                         sorted(expected))
+        for user in users.values():
+            self.assertEqual([found.id for found in
+                              User.search({"email": user.email})], [user.id])
+        if not User._storage().queryable:
+            self.assertEqual(base.ORDER["User"], sorted(expected))
+            emails = base.INDEX["User"]["email"]
+            self.assertEqual({email: set(bucket)
+                              for email, bucket in emails.items()},
+                             {user.email: {user.id}
+                              for user in users.values()})
+
+        stored = {obj_id: user.to_json(True)
+                  for obj_id, user in users.items()}
+        base.DATA.pop("User", None)
+        User.load_from_file()
+        if lazy_load or User._storage().queryable:
+            # nothing is built before it is accessed
+            self.assertEqual(len(base.DATA["User"]), 0)
+            if lazy_load:
+                self.assertEqual(len(base.LAZY["User"]), len(stored))
+            user = next(iter(users.values()))
+            self.assertEqual(User.get(user.id).to_json(True),
+                             stored[user.id])
+            self.assertEqual(len(base.DATA["User"]), 1)
+        self.assertEqual({user.id: user.to_json(True)
+                          for user in User.all()}, stored)
+
+    def test_file(self):
+        """ JSON snapshot rewritten on every change
+        """
+        self.run_stress("file")
+
+    def test_journal(self):
+        """ Journal of the changes
+        """
+        self.run_stress("journal")
+
+    def test_binary(self):
+        """ Binary snapshot rewritten on every change
+        """
+        self.run_stress("binary")
+
+    def test_binary_journal(self):
+        """ Journal over a binary snapshot
+        """
+        self.run_stress("binary_journal")
+
+    def test_file_lazy(self):
+        """ JSON snapshot with lazy loading
+        """
+        self.run_stress("file", lazy_load=True)
+
+    def test_journal_lazy(self):
+        """ Journal with lazy loading
+        """
+        self.run_stress("journal", lazy_load=True)
+
+    def test_sqlite(self):
+        """ SQLite database
+        """
+        self.run_stress("sqlite")
+
+
+if __name__ == "__main__":
+    unittest.main()
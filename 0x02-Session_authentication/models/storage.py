@@ -0,0 +1,923 @@
+#!/usr/bin/env python3
+""" Storage module
+Persistence backends of the models, selected per class by STORAGE
+"""
+from array import array
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice, repeat
+from os import getenv, path
+from typing import Callable, Iterator, List, Optional, Tuple
+import fcntl
+import json
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import zlib
+
+
+JOURNAL_MAX_ENTRIES = int(getenv("MODELS_JOURNAL_MAX_ENTRIES", 10000))
+JOURNAL_MAX_BYTES = int(getenv("MODELS_JOURNAL_MAX_BYTES", 16 * 1024 * 1024))
+JOURNAL_COMPACT_INTERVAL = float(getenv("MODELS_JOURNAL_COMPACT_INTERVAL",
+                                        300))
+SQLITE_PATH = getenv("MODELS_SQLITE_PATH", ".db.sqlite3")
+# zlib level of the binary snapshots, 0 to store them uncompressed
+BINARY_COMPRESSION = int(getenv("MODELS_BINARY_COMPRESSION", 0))
+# placeholder of the attributes an object does not have
+_absent = object()
+
+
+class Storage():
+    """ Interface of a storage backend
+    Objects are exchanged as their to_json(True) dictionaries
+    """
+
+    # whether put() and delete() persist a single object, otherwise every
+    # change goes through a full dump()
+    incremental = False
+    # whether objects are read on demand with get(), search(), ids() and
+    # count() instead of being loaded all at once by load()
+    queryable = False
+    # whether dump() receives and load() may return timestamps as datetime
+    # values rather than TIMESTAMP_FORMAT strings
+    native_timestamps = False
+
+    def __init__(self):
+        """ Initialize the inter-process lock state of each class
+        """
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def load(self, cls) -> dict:
+        """ Return the JSON dictionaries of all stored objects by ID
+        """
+        raise NotImplementedError
+
+    def dump(self, cls, objs_json: dict):
+        """ Replace all stored objects
+        """
+        raise NotImplementedError
+
+    def put(self, cls, obj_json: dict):
+        """ Insert or update one object
+        """
+        raise NotImplementedError
+
+    def delete(self, cls, obj_id: str):
+        """ Delete one object
+        """
+        raise NotImplementedError
+
+    def put_many(self, cls, objs_json: List[dict]):
+        """ Insert or update several objects
+        """
+        for obj_json in objs_json:
+            self.put(cls, obj_json)
+
+    def delete_many(self, cls, obj_ids: List[str]):
+        """ Delete several objects
+        """
+        for obj_id in obj_ids:
+            self.delete(cls, obj_id)
+
+    def get(self, cls, obj_id: str) -> Optional[dict]:
+        """ Return the JSON dictionary of one object, None if not found
+        """
+        raise NotImplementedError
+
+    def search(self, cls, attributes: dict) -> Optional[List[dict]]:
+        """ Return the JSON dictionaries of the objects with matching
+        attributes, None if the backend can't query these attributes
+        """
+        raise NotImplementedError
+
+    def ids(self, cls) -> List[str]:
+        """ Return the IDs of all stored objects
+        """
+        raise NotImplementedError
+
+    def page(self, cls, after: Optional[str], limit: int) -> List[dict]:
+        """ Return the JSON dictionaries of at most `limit` objects in ID
+        order, with an ID greater than `after` unless it is None
+        """
+        raise NotImplementedError
+
+    def count(self, cls) -> int:
+        """ Return the number of stored objects
+        """
+        raise NotImplementedError
+
+    def token(self, cls):
+        """ Return a cheap token of the stored state, that changes when
+        another process writes
+        """
+        return None
+
+    def size(self, cls) -> Optional[int]:
+        """ Return the size in bytes of the stored objects, None if
+        unknown
+        """
+        return None
+
+    def changes(self, cls, token) -> Tuple[object, Optional[List[tuple]]]:
+        """ Return the current token and what changed since `token`: an
+        empty list when nothing did, ("put", obj_json) and ("del", id)
+        changes when they can be read incrementally, None when everything
+        must be reloaded
+        """
+        current = self.token(cls)
+        return current, [] if current == token else None
+
+    @contextmanager
+    def lock(self, cls) -> Iterator[None]:
+        """ Hold an exclusive flock on .db_<Class>.lock, re-entrant in the
+        process
+        """
+        with self._locks_lock:
+            state = self._locks.setdefault(cls.__name__, {
+                "lock": threading.RLock(), "depth": 0, "file": None})
+        with state["lock"]:
+            if state["depth"] == 0:
+                state["file"] = open(".db_{}.lock".format(cls.__name__), 'a')
+                fcntl.flock(state["file"], fcntl.LOCK_EX)
+            state["depth"] += 1
+            try:
+                yield
+            finally:
+                state["depth"] -= 1
+                if state["depth"] == 0:
+                    fcntl.flock(state["file"], fcntl.LOCK_UN)
+                    state["file"].close()
+                    state["file"] = None
+
+
+class FileStorage(Storage):
+    """ Whole-file JSON storage in .db_<Class>.json
+    """
+
+    @staticmethod
+    def _signature(file_path: str):
+        """ Identity of a file version: inode, size and modification time
+        """
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def token(self, cls):
+        """ Return the signature of the JSON file
+        """
+        return self._signature(self.file_path(cls))
+
+    def size(self, cls) -> Optional[int]:
+        """ Return the size in bytes of the file
+        """
+        signature = self._signature(self.file_path(cls))
+        return signature[1] if signature else 0
+
+    @staticmethod
+    def file_path(cls) -> str:
+        """ Path of the JSON file of a class
+        """
+        return ".db_{}.json".format(cls.__name__)
+
+    def load(self, cls) -> dict:
+        """ Return the JSON dictionaries of all stored objects by ID
+        """
+        file_path = self.file_path(cls)
+        if not path.exists(file_path):
+            return {}
+        with open(file_path, 'r') as f:
+            return json.load(f)
+
+    def dump(self, cls, objs_json: dict):
+        """ Replace all stored objects, atomically so that other processes
+        never read a partial file
+        """
+        file_path = self.file_path(cls)
+        tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            # encoded at once in C, json.dump would encode in chunks
+            f.write(json.dumps(objs_json))
+        os.replace(tmp_path, file_path)
+
+
+class BinaryStorage(FileStorage):
+    """ Versioned binary snapshot in .db_<Class>.bin, stored by column so
+    that each column is decoded at once
+    Layout, little-endian:
+    - header: magic "MDLB", format version (u8) and flags (u8), then the
+      body, zlib-compressed with the COMPRESSED flag
+    - body: the number of attributes (u16) and their names (u16 length
+      and UTF-8), the number of records (u32), then one column per
+      attribute
+    - column: the type tag (u8) of all its values, or MIXED followed by
+      one type tag per record, then its JSON, INT, FLOAT and TIMESTAMP
+      sections, each a u32 length and the values of that type in record
+      order
+    - values: nothing for ABSENT, NONE, FALSE and TRUE, one UTF-8 JSON
+      array for the TEXT and other JSON values, i64 for INT, f64 for
+      FLOAT and one JSON array of ISO 8601 dates to the second for
+      TIMESTAMP, which the C parser reads faster than it adds seconds to
+      the epoch
+    """
+
+    native_timestamps = True
+    MAGIC = b"MDLB"
+    VERSION = 3
+    COMPRESSED = 0x01
+    # type tags of the values
+    ABSENT, NONE, FALSE, TRUE, INT, FLOAT, TEXT, TIMESTAMP, JSON = range(9)
+    MIXED = 0xFF
+    _header = struct.Struct("<4sBB")
+    _u16 = struct.Struct("<H")
+    _u32 = struct.Struct("<I")
+    # arrays are in the machine byte order, snapshots in little-endian
+    _swap = sys.byteorder != 'little'
+
+    def __init__(self, compression: int = BINARY_COMPRESSION):
+        """ Initialize the binary storage with a zlib level, 0 to store
+        the snapshots uncompressed
+        """
+        super().__init__()
+        self.compression = compression
+
+    @staticmethod
+    def file_path(cls) -> str:
+        """ Path of the binary snapshot of a class
+        """
+        return ".db_{}.bin".format(cls.__name__)
+
+    @classmethod
+    def _tag(cls, value) -> int:
+        """ Type tag of a value
+        """
+        kind = type(value)
+        if kind is str:
+            return cls.TEXT
+        if value is None:
+            return cls.NONE
+        if kind is datetime and value.tzinfo is None:
+            return cls.TIMESTAMP
+        if kind is bool:
+            return cls.TRUE if value else cls.FALSE
+        if kind is int and -2 ** 63 <= value < 2 ** 63:
+            return cls.INT
+        if kind is float:
+            return cls.FLOAT
+        return cls.JSON
+
+    @classmethod
+    def _array(cls, typecode: str, values: list) -> bytes:
+        """ Little-endian bytes of an array of numbers
+        """
+        values = array(typecode, values)
+        if cls._swap:
+            values.byteswap()
+        return values.tobytes()
+
+    @staticmethod
+    def _json(values: list) -> bytes:
+        """ UTF-8 JSON array of values, empty without values
+        """
+        if not values:
+            return b""
+        return json.dumps(values, ensure_ascii=False).encode(
+            'utf-8', 'surrogatepass')
+
+    @staticmethod
+    def _unjson(data: bytes) -> list:
+        """ Values of a UTF-8 JSON array, empty without data
+        """
+        values = json.loads(str(data, 'utf-8', 'surrogatepass')) \
+            if data else []
+        if type(values) is not list:
+            raise ValueError("values are not a list")
+        return values
+
+    @classmethod
+    def _encode_column(cls, values: list) -> bytes:
+        """ Encode the values of one attribute, ABSENT where an object
+        does not have it
+        """
+        kinds = set(map(type, values))
+        if kinds == {str}:
+            tags = [cls.TEXT]
+        elif kinds == {datetime} and \
+                all(value.tzinfo is None for value in values):
+            tags = [cls.TIMESTAMP]
+        else:
+            tags = [cls.ABSENT if value is _absent else cls._tag(value)
+                    for value in values]
+        texts, ints, floats, timestamps = [], [], [], []
+        for tag, value in zip(tags if len(tags) > 1 else repeat(tags[0]),
+                              values):
+            if tag == cls.TEXT or tag == cls.JSON:
+                if type(value) is datetime:
+                    value = value.isoformat(timespec='seconds')
+                texts.append(value)
+            elif tag == cls.TIMESTAMP:
+                timestamps.append(value.isoformat(timespec='seconds'))
+            elif tag == cls.INT:
+                ints.append(value)
+            elif tag == cls.FLOAT:
+                floats.append(value)
+        if len(tags) > 1 and len(set(tags)) == 1:
+            tags = tags[:1]
+        chunks = [bytes(tags) if len(tags) == 1
+                  else bytes([cls.MIXED]) + bytes(tags)]
+        for section in (cls._json(texts), cls._array('q', ints),
+                        cls._array('d', floats), cls._json(timestamps)):
+            chunks.append(cls._u32.pack(len(section)))
+            chunks.append(section)
+        return b"".join(chunks)
+
+    @classmethod
+    def encode(cls, objs_json: dict, compression: int = 0) -> bytes:
+        """ Encode JSON dictionaries by ID to a binary snapshot
+        """
+        objs = list(objs_json.values())
+        names = list(objs[0]) if objs else []
+        names += sorted(set().union(*objs).difference(names))
+        chunks = [cls._u16.pack(len(names))]
+        for name in names:
+            data = name.encode('utf-8')
+            chunks.append(cls._u16.pack(len(data)) + data)
+        chunks.append(cls._u32.pack(len(objs)))
+        for name in names:
+            chunks.append(cls._encode_column(
+                [obj.get(name, _absent) for obj in objs]))
+        body = b"".join(chunks)
+        flags = 0
+        if compression:
+            body = zlib.compress(body, compression)
+            flags |= cls.COMPRESSED
+        return cls._header.pack(cls.MAGIC, cls.VERSION, flags) + body
+
+    @classmethod
+    def decode(cls, data: bytes) -> dict:
+        """ Decode a binary snapshot to JSON dictionaries by ID
+        Raise:
+            ValueError if the data is not a valid snapshot
+        """
+        if len(data) < cls._header.size:
+            raise ValueError("not a binary snapshot")
+        magic, version, flags = cls._header.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise ValueError("not a binary snapshot")
+        if version != cls.VERSION:
+            raise ValueError("unsupported snapshot version: {}"
+                             .format(version))
+        body = data[cls._header.size:]
+        try:
+            if flags & cls.COMPRESSED:
+                body = zlib.decompress(body)
+            return cls._decode_body(body)
+        except (zlib.error, struct.error, IndexError, KeyError,
+                OverflowError, TypeError, UnicodeDecodeError,
+                ValueError) as e:
+            raise ValueError("corrupted binary snapshot: {}".format(e))
+
+    @classmethod
+    def _decode_column(cls, body: bytes, offset: int,
+                       count: int) -> Tuple[list, bool, int]:
+        """ Decode the column of one attribute at an offset
+        Return:
+            its values, whether some are ABSENT and the offset after it
+        """
+        tags, offset = body[offset], offset + 1
+        if tags == cls.MIXED:
+            tags, offset = body[offset:offset + count], offset + count
+            if len(tags) != count:
+                raise ValueError("truncated type tags")
+        sections = []
+        for _ in range(4):
+            size, = cls._u32.unpack_from(body, offset)
+            offset += 4 + size
+            if offset > len(body):
+                raise ValueError("truncated column")
+            sections.append(body[offset - size:offset])
+        texts, dates = cls._unjson(sections[0]), cls._unjson(sections[3])
+        ints, floats = array('q'), array('d')
+        for values, section in zip((ints, floats), sections[1:3]):
+            values.frombytes(section)
+            if cls._swap:
+                values.byteswap()
+        sources = [repeat(_absent), repeat(None), repeat(False),
+                   repeat(True), iter(ints), iter(floats), iter(texts),
+                   map(datetime.fromisoformat, dates), iter(texts)]
+        expected = [0] * len(sources)
+        if type(tags) is int:
+            if tags >= len(sources):
+                raise ValueError("unknown value tag {}".format(tags))
+            expected[tags] = count
+            values = list(islice(sources[tags], count))
+        else:
+            for tag in set(tags):
+                if tag >= len(sources):
+                    raise ValueError("unknown value tag {}".format(tag))
+                expected[tag] = tags.count(tag)
+            values = list(map(next, map(sources.__getitem__, tags)))
+        if len(texts) != expected[cls.TEXT] + expected[cls.JSON] or \
+                len(ints) != expected[cls.INT] or \
+                len(floats) != expected[cls.FLOAT] or \
+                len(dates) != expected[cls.TIMESTAMP] or \
+                len(values) != count:
+            raise ValueError("column length mismatch")
+        return values, expected[cls.ABSENT] > 0, offset
+
+    @classmethod
+    def _decode_body(cls, body: bytes) -> dict:
+        """ Decode the attribute names and the columns of a snapshot
+        """
+        u16, u32 = cls._u16.unpack_from, cls._u32.unpack_from
+        end = len(body)
+        count, = u16(body, 0)
+        offset = 2
+        names = []
+        for _ in range(count):
+            length, = u16(body, offset)
+            offset += 2
+            if offset + length > end:
+                raise ValueError("truncated attribute name")
+            names.append(str(body[offset:offset + length], 'utf-8'))
+            offset += length
+        count, = u32(body, offset)
+        offset += 4
+        if count > end:
+            # at least the IDs take space
+            raise ValueError("truncated records")
+        # filled by column, faster than building each record at once
+        objs = [{} for _ in range(count)]
+        for name in names:
+            values, absent, offset = cls._decode_column(body, offset,
+                                                        count)
+            if not absent:
+                for obj, value in zip(objs, values):
+                    obj[name] = value
+            else:
+                for obj, value in zip(objs, values):
+                    if value is not _absent:
+                        obj[name] = value
+        if offset != end:
+            raise ValueError("trailing data after the columns")
+        return {obj['id']: obj for obj in objs}
+
+    def load(self, cls) -> dict:
+        """ Return the JSON dictionaries of all stored objects by ID
+        """
+        file_path = self.file_path(cls)
+        if not path.exists(file_path):
+            return {}
+        with open(file_path, 'rb') as f:
+            return self.decode(f.read())
+
+    def dump(self, cls, objs_json: dict):
+        """ Replace all stored objects, atomically so that other processes
+        never read a partial file
+        """
+        file_path = self.file_path(cls)
+        tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(self.encode(objs_json, self.compression))
+        os.replace(tmp_path, file_path)
+
+
+class JournalStorage(FileStorage):
+    """ JSON snapshot in .db_<Class>.json plus an append-only journal of
+    the later changes in .db_<Class>.journal, compacted into the snapshot
+    when it grows too large or too old
+    """
+
+    incremental = True
+
+    def __init__(self):
+        """ Initialize the journal state of each class
+        """
+        super().__init__()
+        self.state = {}
+
+    @staticmethod
+    def journal_path(cls) -> str:
+        """ Path of the journal of a class
+        """
+        return ".db_{}.journal".format(cls.__name__)
+
+    def _reset(self, cls, entries: int = 0, size: int = 0):
+        """ Restart the compaction counters of a class
+        """
+        self.state[cls.__name__] = {"entries": entries, "bytes": size,
+                                    "compacted_at": time.monotonic()}
+
+    @staticmethod
+    def _parse(line: bytes) -> Optional[tuple]:
+        """ Return the change of a journal line, None if the line is not
+        a valid entry
+        """
+        try:
+            entry = json.loads(line)
+            if entry["op"] == "put":
+                return ("put", entry["obj"])
+            return ("del", entry["id"])
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    def load(self, cls) -> dict:
+        """ Return the snapshot with the journal entries replayed on it
+        A torn last entry, left by a crash during a write, is truncated
+        so that the next entry starts on its own line, and invalid
+        entries are skipped rather than ending the replay
+        """
+        objs_json = super().load(cls)
+        entries = size = 0
+        journal_path = self.journal_path(cls)
+        if path.exists(journal_path):
+            with open(journal_path, 'rb+') as f:
+                good = 0
+                torn = False
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        torn = True
+                        break
+                    good += len(line)
+                    change = self._parse(line)
+                    if change is None:
+                        continue
+                    if change[0] == "put":
+                        objs_json[change[1]["id"]] = change[1]
+                    else:
+                        objs_json.pop(change[1], None)
+                    entries += 1
+                    size += len(line)
+                if torn:
+                    f.truncate(good)
+        self._reset(cls, entries, size)
+        return objs_json
+
+    def dump(self, cls, objs_json: dict):
+        """ Replace the snapshot atomically and empty the journal
+        """
+        super().dump(cls, objs_json)
+        open(self.journal_path(cls), 'w').close()
+        self._reset(cls)
+
+    def _append(self, cls, entries: List[dict]):
+        """ Append changes to the journal in a single write, compacting it
+        into the snapshot when it grows too large or too old
+        """
+        lines = "".join(json.dumps(entry) + "\n" for entry in entries)
+        with open(self.journal_path(cls), 'ab+') as f:
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # torn last entry: keep it on a line of its own, where
+                    # replays skip it
+                    lines = "\n" + lines
+            f.write(lines.encode())
+        if cls.__name__ not in self.state:
+            self._reset(cls)
+        state = self.state[cls.__name__]
+        state["entries"] += len(entries)
+        state["bytes"] += len(lines)
+        if state["entries"] >= JOURNAL_MAX_ENTRIES \
+                or state["bytes"] >= JOURNAL_MAX_BYTES \
+                or time.monotonic() - state["compacted_at"] \
+                >= JOURNAL_COMPACT_INTERVAL:
+            cls.save_to_file()
+
+    def size(self, cls) -> Optional[int]:
+        """ Return the size in bytes of the snapshot and the journal
+        """
+        journal = self._signature(self.journal_path(cls))
+        return super().size(cls) + (journal[1] if journal else 0)
+
+    def token(self, cls):
+        """ Return the signature of the snapshot and the size of the journal
+        """
+        journal = self._signature(self.journal_path(cls))
+        return (self._signature(self.file_path(cls)),
+                journal[1] if journal else 0)
+
+    def changes(self, cls, token) -> Tuple[object, Optional[List[tuple]]]:
+        """ Read the journal entries appended since `token`, unless the
+        snapshot changed
+        """
+        current = self.token(cls)
+        if token is None or current[0] != token[0] or current[1] < token[1]:
+            return current, None
+        if current == token:
+            return current, []
+        changes = []
+        offset = token[1]
+        with open(self.journal_path(cls), 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # entry still being written, read it next time
+                    break
+                offset += len(line)
+                change = self._parse(line)
+                if change is not None:
+                    changes.append(change)
+        return (current[0], offset), changes
+
+    def put(self, cls, obj_json: dict):
+        """ Journal the insert or update of one object
+        """
+        self.put_many(cls, [obj_json])
+
+    def delete(self, cls, obj_id: str):
+        """ Journal the deletion of one object
+        """
+        self.delete_many(cls, [obj_id])
+
+    def put_many(self, cls, objs_json: List[dict]):
+        """ Journal the insert or update of several objects
+        """
+        self._append(cls, [{"op": "put", "id": obj_json["id"],
+                            "obj": obj_json} for obj_json in objs_json])
+
+    def delete_many(self, cls, obj_ids: List[str]):
+        """ Journal the deletion of several objects
+        """
+        self._append(cls, [{"op": "del", "id": obj_id}
+                           for obj_id in obj_ids])
+
+
+class BinaryJournalStorage(JournalStorage, BinaryStorage):
+    """ Binary snapshot in .db_<Class>.bin plus the JSON journal of the
+    later changes in .db_<Class>.journal
+    """
+
+
+class SQLiteStorage(Storage):
+    """ SQLite storage with one table per class, one column per declared
+    attribute and an index on each attribute of INDEXES
+    """
+
+    incremental = True
+    queryable = True
+
+    def __init__(self, db_path: str = SQLITE_PATH):
+        """ Open the database, shared by all threads behind a lock
+        """
+        super().__init__()
+        self.db_path = db_path
+        self._open()
+        self._tables = set()
+        self._inherited = []
+        # a connection must not be used across fork(): forked workers
+        # open their own
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _open(self):
+        """ Open the connection and its lock
+        """
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                     isolation_level=None)
+        self._lock = threading.Lock()
+
+    def _after_fork(self):
+        """ Open a new connection in a forked child, keeping the inherited
+        one referenced: closing it would release the locks and discard
+        the journal the parent still holds
+        """
+        self._inherited.append(self._conn)
+        self._open()
+
+    @staticmethod
+    def _quote(name: str) -> str:
+        """ Quote an identifier
+        """
+        return '"{}"'.format(name.replace('"', '""'))
+
+    @staticmethod
+    def _value(value):
+        """ Convert an attribute value to a value SQLite can store: any
+        value other than a string or a number is stored as a JSON blob,
+        which _rows() decodes
+        """
+        if value is None or type(value) in (str, int, float):
+            return value
+        return json.dumps(value).encode('utf-8')
+
+    def _table(self, cls) -> str:
+        """ Create the table of a class and its indexes if needed, and
+        return its quoted name
+        """
+        table = self._quote(cls.__name__)
+        if cls.__name__ in self._tables:
+            return table
+        # columns without a declared type keep the type of their values
+        columns = ", ".join(self._quote(f) for f in cls.fields()
+                            if f != 'id')
+        self._conn.execute("CREATE TABLE IF NOT EXISTS {} "
+                           "(id TEXT PRIMARY KEY, {})".format(table, columns))
+        for attr in cls.INDEXES:
+            self._conn.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({})"
+                               .format(self._quote("ix_{}_{}".format(
+                                   cls.__name__, attr)),
+                                   table, self._quote(attr)))
+        self._tables.add(cls.__name__)
+        return table
+
+    def _rows(self, cls, cursor) -> List[dict]:
+        """ Convert the rows of a SELECT * to JSON dictionaries
+        """
+        columns = [c[0] for c in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        for row in rows:
+            for column, value in row.items():
+                if type(value) is bytes:
+                    row[column] = json.loads(value)
+        return rows
+
+    def load(self, cls) -> dict:
+        """ Objects are read on demand: only make sure the table exists
+        """
+        with self._lock:
+            self._table(cls)
+        return {}
+
+    def dump(self, cls, objs_json: dict):
+        """ Replace all rows of the class in one transaction
+        """
+        with self._lock:
+            table = self._table(cls)
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("DELETE FROM {}".format(table))
+                for obj_json in objs_json.values():
+                    self._put(cls, table, obj_json)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _put(self, cls, table: str, obj_json: dict):
+        """ Upsert one row, keeping the position of an updated row
+        """
+        fields = [f for f in cls.fields() if f in obj_json]
+        self._conn.execute(
+            "INSERT INTO {} ({}) VALUES ({}) ON CONFLICT(id) DO UPDATE SET "
+            "{}".format(table, ", ".join(self._quote(f) for f in fields),
+                        ", ".join("?" for _ in fields),
+                        ", ".join("{0} = excluded.{0}".format(self._quote(f))
+                                  for f in fields if f != 'id')),
+            [self._value(obj_json[f]) for f in fields])
+
+    def put(self, cls, obj_json: dict):
+        """ Insert or update one row
+        """
+        with self._lock:
+            self._put(cls, self._table(cls), obj_json)
+
+    def delete(self, cls, obj_id: str):
+        """ Delete one row
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM {} WHERE id = ?".format(
+                self._table(cls)), (obj_id,))
+
+    def put_many(self, cls, objs_json: List[dict]):
+        """ Insert or update several rows in one transaction
+        """
+        with self._lock:
+            table = self._table(cls)
+            self._conn.execute("BEGIN")
+            try:
+                for obj_json in objs_json:
+                    self._put(cls, table, obj_json)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def delete_many(self, cls, obj_ids: List[str]):
+        """ Delete several rows in one transaction
+        """
+        with self._lock:
+            table = self._table(cls)
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("DELETE FROM {} WHERE id = ?".format(
+                    table), [(obj_id,) for obj_id in obj_ids])
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get(self, cls, obj_id: str) -> Optional[dict]:
+        """ Return the JSON dictionary of one row, None if not found
+        """
+        with self._lock:
+            cursor = self._conn.execute("SELECT * FROM {} WHERE id = ?"
+                                        .format(self._table(cls)), (obj_id,))
+            rows = self._rows(cls, cursor)
+        return rows[0] if rows else None
+
+    def search(self, cls, attributes: dict) -> Optional[List[dict]]:
+        """ Return the JSON dictionaries of the rows with matching columns,
+        None if an attribute is not a column
+        """
+        fields = cls.fields()
+        if any(k not in fields for k in attributes):
+            return None
+        where = " AND ".join("{} IS ?".format(self._quote(k))
+                             for k in attributes)
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT * FROM {}{} ORDER BY rowid".format(
+                    self._table(cls), " WHERE " + where if where else ""),
+                [self._value(v) for v in attributes.values()])
+            return self._rows(cls, cursor)
+
+    def ids(self, cls) -> List[str]:
+        """ Return the IDs of all rows
+        """
+        with self._lock:
+            cursor = self._conn.execute("SELECT id FROM {}".format(
+                self._table(cls)))
+            return [row[0] for row in cursor.fetchall()]
+
+    def page(self, cls, after: Optional[str], limit: int) -> List[dict]:
+        """ Return the JSON dictionaries of at most `limit` rows in ID
+        order, with an ID greater than `after` unless it is None, read
+        through the primary key index
+        """
+        with self._lock:
+            table = self._table(cls)
+            if after is None:
+                cursor = self._conn.execute(
+                    "SELECT * FROM {} ORDER BY id LIMIT ?".format(table),
+                    (limit,))
+            else:
+                cursor = self._conn.execute(
+                    "SELECT * FROM {} WHERE id > ? ORDER BY id LIMIT ?"
+                    .format(table), (after, limit))
+            return self._rows(cls, cursor)
+
+    def count(self, cls) -> int:
+        """ Return the number of rows
+        """
+        with self._lock:
+            cursor = self._conn.execute("SELECT COUNT(*) FROM {}".format(
+                self._table(cls)))
+            return cursor.fetchone()[0]
+
+    def size(self, cls) -> Optional[int]:
+        """ Return the size in bytes of the pages of the table and its
+        indexes, None if SQLite is built without the dbstat table
+        """
+        with self._lock:
+            table = self._table(cls)
+            try:
+                cursor = self._conn.execute(
+                    "SELECT SUM(pgsize) FROM dbstat WHERE name = ? OR name "
+                    "IN (SELECT name FROM sqlite_master WHERE tbl_name = ?)",
+                    (cls.__name__, cls.__name__))
+            except sqlite3.Error:
+                return None
+            return cursor.fetchone()[0] or 0
+
+    def token(self, cls):
+        """ Return the data version of the database, which changes when
+        another connection commits
+        """
+        with self._lock:
+            return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+
+BACKENDS = {
+    "file": FileStorage,
+    "journal": JournalStorage,
+    "binary": BinaryStorage,
+    "binary_journal": BinaryJournalStorage,
+    "sqlite": SQLiteStorage,
+}
+STORAGES = {}
+_storages_lock = threading.Lock()
+
+
+def register_storage(name: str, factory: Callable[[], Storage]):
+    """ Make a storage backend available to the STORAGE of the models
+    """
+    BACKENDS[name] = factory
+
+
+def get_storage(name: str) -> Storage:
+    """ Return the shared instance of a storage backend
+    """
+    storage = STORAGES.get(name)
+    if storage is None:
+        if name not in BACKENDS:
+            raise ValueError("unknown storage: {}".format(name))
+        with _storages_lock:
+            storage = STORAGES.get(name)
+            if storage is None:
+                storage = STORAGES[name] = BACKENDS[name]()
+    return storage
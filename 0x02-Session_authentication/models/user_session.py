@@ -1,14 +1,32 @@
 #!/usr/bin/env python3
 """ UserSession module
 """
+from os import getenv
+
 from models.base import Base
 
 
+def session_duration() -> int:
+    """
+    Returns the lifetime in seconds of a session, from SESSION_DURATION
+    like SessionExpAuth, 0 if sessions never expire
+    """
+    try:
+        return max(int(getenv('SESSION_DURATION')), 0)
+    except Exception:
+        return 0
+
+
 class UserSession(Base):
     """
     UserSession class
     """
 
+    __slots__ = ('user_id', 'session_id')
+
+    INDEXES = ("session_id", "user_id")
+    EXPIRES_AFTER = session_duration()
+
     def __init__(self, *args: list, **kwargs: dict):
         """
         Initialize a UserSession instance